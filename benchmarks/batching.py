@@ -0,0 +1,51 @@
+"""Benchmark of iteration.MaterializedBatch against the lazy iteration.Batch
+
+Usage: PYTHONPATH=. python benchmarks/batching.py [num_items] [batch_size]
+"""
+import sys
+import timeit
+
+from skills_utils.iteration import Batch, MaterializedBatch
+
+
+def consume_lazy(items, batch_size):
+    for group in Batch(items, batch_size):
+        list(group)
+
+
+def consume_materialized(items, batch_size, **kwargs):
+    for batch in MaterializedBatch(items, batch_size, **kwargs):
+        pass
+
+
+def benchmark(num_items=1000000, batch_size=500, repeat=3):
+    """Time batching num_items strings in each mode
+
+    Returns: (dict) mode to items/sec
+    """
+    items = ['posting {}'.format(i) for i in range(num_items)]
+    modes = {
+        'Batch (lazy)': lambda: consume_lazy(items, batch_size),
+        'MaterializedBatch (limit)': lambda: consume_materialized(items, batch_size),
+        'MaterializedBatch (limit, max_bytes)': lambda: consume_materialized(
+            items,
+            batch_size,
+            max_bytes=batch_size * 10
+        ),
+        'MaterializedBatch (limit, max_wait)': lambda: consume_materialized(
+            items,
+            batch_size,
+            max_wait=1
+        ),
+    }
+    return {
+        mode: num_items / min(timeit.repeat(function, number=1, repeat=repeat))
+        for mode, function in modes.items()
+    }
+
+
+if __name__ == '__main__':
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    for mode, rate in benchmark(num_items, batch_size).items():
+        print('{:40} {:12.0f} items/sec'.format(mode, rate))
@@ -0,0 +1,133 @@
+"""Benchmark of ElasticsearchIndexerBase bulk indexing against a local
+FakeElasticsearchServer, across chunk sizes and thread counts
+
+Reports documents/sec and peak Python memory (from tracemalloc, in a
+separate run since tracing slows indexing down) for index_all, and the time
+replace() takes end to end, including zero_downtime_index and atomic_swap.
+The server runs in its own process so it does not compete with the indexer
+for the GIL.
+
+Usage: PYTHONPATH=. python benchmarks/es_indexing.py [num_documents] [latency] [rejection_rate]
+"""
+from multiprocessing import Event, Pipe, Process
+from unittest.mock import patch
+import contextlib
+import itertools
+import sys
+import time
+import tracemalloc
+
+from skills_utils import es
+from skills_utils.es import ElasticsearchIndexerBase
+from skills_utils.testing import FakeElasticsearchServer
+
+sys.path.insert(0, 'benchmarks')
+from json_backends import sample_posting  # noqa: E402
+
+CHUNK_SIZES = [100, 500, 2000]
+THREAD_COUNTS = [1, 2, 4, 8]
+
+
+class BenchmarkIndexer(ElasticsearchIndexerBase):
+    alias_name = 'benchmark'
+    settings = {'number_of_replicas': 1}
+    mappings = {}
+
+    def __init__(self, es_client, num_documents):
+        super().__init__(None, es_client)
+        self.num_documents = num_documents
+
+    def _iter_documents(self, target_index):
+        for i in range(self.num_documents):
+            yield {
+                '_op_type': 'index',
+                '_index': target_index,
+                '_type': 'job_posting',
+                '_id': str(i),
+                '_source': sample_posting(i),
+            }
+
+
+def _serve(connection, stop, server_kwargs):
+    with FakeElasticsearchServer(**server_kwargs) as server:
+        connection.send(server.host)
+        stop.wait()
+
+
+@contextlib.contextmanager
+def server_process(**server_kwargs):
+    """Run a FakeElasticsearchServer in a child process
+
+    Yields: (str) the host:port it listens on
+    """
+    receiver, sender = Pipe(duplex=False)
+    stop = Event()
+    process = Process(target=_serve, args=(sender, stop, server_kwargs), daemon=True)
+    process.start()
+    try:
+        yield receiver.recv()
+    finally:
+        stop.set()
+        process.join()
+
+
+def configured_indexer(host, num_documents, chunk_size, threads):
+    indexer = BenchmarkIndexer(es.get_client(hosts=[host]), num_documents)
+    indexer.BULK_CHUNK_SIZE = chunk_size
+    indexer.BULK_THREADS = threads
+    indexer.BULK_QUEUE_SIZE = threads
+    indexer.BULK_MAX_RETRIES = 5
+    indexer.BULK_INITIAL_BACKOFF = 0.01
+    return indexer
+
+
+def index_all_once(host, num_documents, chunk_size, threads):
+    """Returns: (float) seconds to index num_documents into a new index"""
+    indexer = configured_indexer(host, num_documents, chunk_size, threads)
+    indices = es.IndicesClient(indexer.es_client)
+    index_name = 'benchmark_{}_{}'.format(chunk_size, threads)
+    es.create_index(index_name, indexer.index_config(), indices)
+    start = time.time()
+    indexer.index_all(index_name)
+    elapsed = time.time() - start
+    indices.delete(index=index_name)
+    return elapsed
+
+
+def benchmark_index_all(host, num_documents, chunk_size, threads):
+    """Returns: (tuple) documents/sec and peak traced memory in MB"""
+    elapsed = index_all_once(host, num_documents, chunk_size, threads)
+    tracemalloc.start()
+    index_all_once(host, num_documents, chunk_size, threads)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return num_documents / elapsed, peak / 1024 / 1024
+
+
+def benchmark_replace(host, num_documents, chunk_size, threads, bulk_load):
+    """Returns: (float) seconds for replace()"""
+    indexer = configured_indexer(host, num_documents, chunk_size, threads)
+    indexer.BULK_LOAD = bulk_load
+    start = time.time()
+    with patch.object(es, 'HOSTNAME', host):
+        indexer.replace()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    num_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.005
+    rejection_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = server_process(
+        latency=latency,
+        rejection_rate=rejection_rate,
+        store_documents=False
+    )
+    with server as host:
+        print('{:>6} {:>8} {:>12} {:>12}'.format('chunk', 'threads', 'docs/sec', 'peak MB'))
+        for chunk_size, threads in itertools.product(CHUNK_SIZES, THREAD_COUNTS):
+            rate, peak = benchmark_index_all(host, num_documents, chunk_size, threads)
+            print('{:>6} {:>8} {:>12.0f} {:>12.1f}'.format(chunk_size, threads, rate, peak))
+        for bulk_load in (False, True):
+            seconds = benchmark_replace(host, num_documents, 500, 4, bulk_load)
+            print('replace(), bulk_load={}: {:.2f}s'.format(bulk_load, seconds))
@@ -0,0 +1,81 @@
+"""Benchmark of the overhead ImportStats adds to JobPostingImportBase.postings
+
+Uses an importer whose transform does the kind of work partner importers do
+(date parsing, building nested common schema fields). Pass --trivial to use a
+transform that only copies the document, as a worst case.
+
+Usage: PYTHONPATH=. python benchmarks/import_stats.py [num_postings] [--trivial]
+"""
+from datetime import datetime
+import sys
+import timeit
+
+from skills_utils.job_posting_import import ImportStats, JobPostingImportBase
+
+sys.path.insert(0, 'benchmarks')
+from json_backends import sample_posting  # noqa: E402
+
+
+class BenchmarkImporter(JobPostingImportBase):
+    def __init__(self, raw_postings):
+        super().__init__(partner_id='XX')
+        self.raw_postings = raw_postings
+
+    def _iter_postings(self, quarter):
+        return iter(self.raw_postings)
+
+    def _transform(self, document):
+        date_posted = datetime.strptime(document['datePosted'], '%Y-%m-%d')
+        address = document['jobLocation']['address']
+        return {
+            '@context': 'http://schema.org',
+            '@type': 'JobPosting',
+            'title': document['title'].strip().title(),
+            'description': document['description'].strip(),
+            'datePosted': date_posted.date().isoformat(),
+            'validThrough': document['validThrough'],
+            'jobLocation': {
+                '@type': 'Place',
+                'address': {
+                    '@type': 'PostalAddress',
+                    'addressLocality': address['addressLocality'],
+                    'addressRegion': address['addressRegion'],
+                }
+            },
+            'skills': sorted(set(document['skills'])),
+        }
+
+
+class TrivialImporter(BenchmarkImporter):
+    def _transform(self, document):
+        return dict(document)
+
+    def _id(self, document):
+        return document['id']
+
+
+def benchmark(num_postings=100000, repeat=9, importer_class=BenchmarkImporter):
+    """Time postings() with no counter and with ImportStats
+
+    Returns: (dict) mode to postings/sec
+    """
+    importer = importer_class([sample_posting(i) for i in range(num_postings)])
+    modes = {
+        'no stats_counter': lambda: sum(1 for _ in importer.postings('2016Q1')),
+        'ImportStats': lambda: sum(1 for _ in importer.postings('2016Q1', stats_counter=ImportStats())),
+    }
+    return {
+        mode: num_postings / min(timeit.repeat(function, number=1, repeat=repeat))
+        for mode, function in modes.items()
+    }
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--trivial']
+    num_postings = int(args[0]) if args else 100000
+    importer_class = TrivialImporter if '--trivial' in sys.argv else BenchmarkImporter
+    results = benchmark(num_postings, importer_class=importer_class)
+    for mode, rate in results.items():
+        print('{:20} {:12.0f} postings/sec'.format(mode, rate))
+    baseline, with_stats = results['no stats_counter'], results['ImportStats']
+    print('overhead: {:.1f}%'.format(100 * (baseline - with_stats) / baseline))
@@ -0,0 +1,81 @@
+"""Micro-benchmark of the JSON backends available to skills_utils.serialization
+
+Serializes and deserializes a batch of synthetic common schema job postings
+with each installed backend and reports documents per second.
+
+Usage: PYTHONPATH=. python benchmarks/json_backends.py [num_documents]
+"""
+import random
+import sys
+import timeit
+
+from skills_utils.serialization import available_backends, get_backend
+from skills_utils.testing import MANDATORY_FIELDS
+
+WORDS = (
+    'manage develop customer service team project data analysis sales '
+    'support maintain design software engineer nurse patient care warehouse '
+    'inventory schedule training safety quality communication excellent'
+).split()
+
+
+def sample_posting(i):
+    """A job posting in common schema form, with a realistic description length"""
+    rng = random.Random(i)
+    posting = {field: '' for field in MANDATORY_FIELDS}
+    posting.update({
+        '@context': 'http://schema.org',
+        '@type': 'JobPosting',
+        'id': 'XX_{}'.format(i),
+        'title': ' '.join(rng.choice(WORDS) for _ in range(4)).title(),
+        'description': ' '.join(rng.choice(WORDS) for _ in range(400)),
+        'datePosted': '2016-0{}-1{}'.format(rng.randint(1, 9), rng.randint(0, 9)),
+        'validThrough': '2016-12-31T00:00:00',
+        'jobLocation': {
+            '@type': 'Place',
+            'address': {
+                'addressLocality': 'Chicago',
+                'addressRegion': 'IL',
+                '@type': 'PostalAddress'
+            }
+        },
+        'baseSalary': {'minValue': rng.randint(20000, 50000), 'maxValue': rng.randint(50000, 150000)},
+        'onet_soc_code': '15-1132.00',
+        'skills': [rng.choice(WORDS) for _ in range(15)],
+        'experienceRequirements': rng.randint(0, 10),
+    })
+    return posting
+
+
+def benchmark(num_documents=2000, repeat=5):
+    """Time each available backend over num_documents postings
+
+    Returns: (dict) backend name to (dumps docs/sec, loads docs/sec)
+    """
+    documents = [sample_posting(i) for i in range(num_documents)]
+    results = {}
+    for name in available_backends():
+        backend = get_backend(name)
+        serialized = [backend.dumps_bytes(document) for document in documents]
+        dumps_time = min(timeit.repeat(
+            lambda: [backend.dumps_bytes(document) for document in documents],
+            number=1,
+            repeat=repeat
+        ))
+        loads_time = min(timeit.repeat(
+            lambda: [backend.loads(line) for line in serialized],
+            number=1,
+            repeat=repeat
+        ))
+        results[name] = (num_documents / dumps_time, num_documents / loads_time)
+    return results
+
+
+if __name__ == '__main__':
+    num_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, (dumps_rate, loads_rate) in benchmark(num_documents).items():
+        print('{:8} dumps: {:10.0f} docs/sec  loads: {:10.0f} docs/sec'.format(
+            name,
+            dumps_rate,
+            loads_rate
+        ))
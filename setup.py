@@ -28,8 +28,9 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
     ],
+    python_requires='>=3.7',
     test_suite='tests',
     tests_require=test_requirements
 )
@@ -0,0 +1,314 @@
+"""Compact, persistable structures for recognizing previously-seen keys,
+such as job posting ids that partners resend across quarters, or documents
+that have not changed since they were last indexed"""
+from array import array
+from bisect import bisect_left
+import heapq
+import logging
+import math
+import struct
+import sys
+
+from skills_utils import serialization
+from skills_utils.fs import read_bytes, write_bytes
+from skills_utils.hash import hash64
+
+UINT64_MASK = 0xffffffffffffffff
+BLOOM_HEADER = struct.Struct('<4sQQQ')
+BLOOM_MAGIC = b'SUBF'
+CONTENT_HASH_HEADER = struct.Struct('<4sQ?')
+CONTENT_HASH_MAGIC = b'SUCH'
+
+
+def _to_little_endian(hashes):
+    if sys.byteorder != 'little':
+        hashes = array('Q', hashes)
+        hashes.byteswap()
+    return hashes
+
+
+class HashSet(object):
+    """An exact set of keys, stored as sorted 64-bit hashes in an array
+
+    Uses 8 bytes per key, instead of the 100 or so a Python set of strings needs.
+    Two keys with the same 64-bit hash are treated as the same key.
+    Recent additions are kept in a small Python set and periodically merged in.
+    """
+    MIN_PENDING = 100000
+
+    def __init__(self, hashes=None):
+        self.hashes = array('Q', sorted(hashes or []))
+        self.pending = set()
+
+    def __len__(self):
+        return len(self.hashes) + len(self.pending)
+
+    def _contains_hash(self, key_hash):
+        if key_hash in self.pending:
+            return True
+        i = bisect_left(self.hashes, key_hash)
+        return i < len(self.hashes) and self.hashes[i] == key_hash
+
+    def __contains__(self, key):
+        return self._contains_hash(hash64(key))
+
+    def add(self, key):
+        """Add a key to the set
+
+        Returns: (bool) True if the key was not already present
+        """
+        key_hash = hash64(key)
+        if self._contains_hash(key_hash):
+            return False
+        self.pending.add(key_hash)
+        if len(self.pending) >= max(self.MIN_PENDING, len(self.hashes) // 8):
+            self._merge()
+        return True
+
+    def _merge(self):
+        if self.pending:
+            # only the pending hashes are sorted, and the merge fills the new
+            # array directly rather than through a list of Python ints
+            self.hashes = array('Q', heapq.merge(self.hashes, sorted(self.pending)))
+            self.pending = set()
+
+    def save(self, path):
+        """Save the set to a local file or s3://bucket/key path"""
+        self._merge()
+        write_bytes(path, _to_little_endian(self.hashes).tobytes())
+        logging.info('Saved %d hashes to %s', len(self), path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a set saved to a local file or s3://bucket/key path.
+        Returns an empty set if nothing has been saved there yet"""
+        data = read_bytes(path)
+        hash_set = cls()
+        if data:
+            hash_set.hashes.frombytes(data)
+            if sys.byteorder != 'little':
+                hash_set.hashes.byteswap()
+        logging.info('Loaded %d hashes from %s', len(hash_set), path)
+        return hash_set
+
+
+class BloomFilter(object):
+    """A probabilistic set of keys with a configurable false-positive rate
+
+    Keys are never wrongly reported as absent, but may occasionally be
+    wrongly reported as present; with the given capacity, at a rate of
+    about error_rate. Uses about 1.2 bytes per key at a 1% rate,
+    and 1.8 bytes per key at 0.1%.
+
+    Args:
+        capacity (int) The number of keys expected
+        error_rate (float) The desired false-positive rate at that capacity
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, key):
+        first = hash64(key)
+        # a second, independent-enough hash for double hashing
+        second = ((first * 0x9e3779b97f4a7c15) & UINT64_MASK) | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """Add a key to the filter
+
+        Returns: (bool) True if the key was not (as far as the filter can tell) already present
+        """
+        bits = self.bits
+        added = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def save(self, path):
+        """Save the filter to a local file or s3://bucket/key path"""
+        header = BLOOM_HEADER.pack(BLOOM_MAGIC, self.num_bits, self.num_hashes, self.count)
+        write_bytes(path, header + bytes(self.bits))
+        logging.info('Saved bloom filter with %d keys to %s', self.count, path)
+
+    @classmethod
+    def load(cls, path, capacity, error_rate=0.001):
+        """Load a filter saved to a local file or s3://bucket/key path.
+        Returns a new, empty filter with the given capacity and error rate
+        if nothing has been saved there yet"""
+        data = read_bytes(path)
+        bloom_filter = cls(capacity, error_rate)
+        if data:
+            magic, num_bits, num_hashes, count = BLOOM_HEADER.unpack_from(data)
+            if magic != BLOOM_MAGIC:
+                raise ValueError('{} is not a saved bloom filter'.format(path))
+            bloom_filter.num_bits = num_bits
+            bloom_filter.num_hashes = num_hashes
+            bloom_filter.count = count
+            bloom_filter.bits = bytearray(data[BLOOM_HEADER.size:])
+        logging.info('Loaded bloom filter with %d keys from %s', len(bloom_filter), path)
+        return bloom_filter
+
+
+class ContentHashStore(object):
+    """Remembers a hash of each key's content, to tell which keys changed
+    since the last run
+
+    Stored as two parallel arrays of 64-bit hashes sorted by key hash;
+    16 bytes per key. Changes are staged during a run and only applied
+    on commit, so keys whose changes could not be processed (e.g. failed
+    to index) can be unstaged and will be reported as changed again.
+
+    Args:
+        keep_keys (bool) Whether to also store the keys themselves, which is
+            needed to list keys that were not seen during a run (e.g. to delete them)
+    """
+    def __init__(self, keep_keys=False):
+        self.key_hashes = array('Q')
+        self.content_hashes = array('Q')
+        self.keys = [] if keep_keys else None
+        self.seen = bytearray()
+        self.staged = {}
+
+    def __len__(self):
+        return len(self.key_hashes)
+
+    def _find(self, key_hash):
+        i = bisect_left(self.key_hashes, key_hash)
+        if i < len(self.key_hashes) and self.key_hashes[i] == key_hash:
+            return i
+        return None
+
+    def stage(self, key, content_hash):
+        """Record the current content hash of a key
+
+        Args:
+            key (str) The key, e.g. a document id
+            content_hash (int) An unsigned 64-bit hash of its content
+
+        Returns: (bool) True if the key is new or its content changed
+        """
+        key_hash = hash64(key)
+        i = self._find(key_hash)
+        if i is not None:
+            self.seen[i] = 1
+            if self.content_hashes[i] == content_hash:
+                return False
+        self.staged[key_hash] = (content_hash, key)
+        return True
+
+    def unstage(self, key):
+        """Forget a staged change, so the key is reported as changed next run"""
+        self.staged.pop(hash64(key), None)
+
+    def keep(self, key):
+        """Mark a stored key as seen, so it survives commit(drop_unseen=True)"""
+        i = self._find(hash64(key))
+        if i is not None:
+            self.seen[i] = 1
+
+    def unseen(self):
+        """Returns: (list) stored keys that were not staged or kept during this run"""
+        if self.keys is None:
+            raise ValueError('Listing unseen keys requires keep_keys')
+        unseen = []
+        i = self.seen.find(0)
+        while i != -1:
+            unseen.append(self.keys[i])
+            i = self.seen.find(0, i + 1)
+        return unseen
+
+    def commit(self, drop_unseen=False):
+        """Apply staged changes and start a new run
+
+        Args:
+            drop_unseen (bool) Whether to forget keys that were not seen during this run
+        """
+        key_hashes = array('Q')
+        content_hashes = array('Q')
+        keys = [] if self.keys is not None else None
+
+        def append(key_hash, content_hash, key):
+            key_hashes.append(key_hash)
+            content_hashes.append(content_hash)
+            if keys is not None:
+                keys.append(key)
+
+        staged = iter(sorted(self.staged.items()))
+        pending = next(staged, None)
+        for i, key_hash in enumerate(self.key_hashes):
+            while pending and pending[0] < key_hash:
+                append(pending[0], *pending[1])
+                pending = next(staged, None)
+            if pending and pending[0] == key_hash:
+                append(pending[0], *pending[1])
+                pending = next(staged, None)
+            elif self.seen[i] or not drop_unseen:
+                append(key_hash, self.content_hashes[i], self.keys[i] if keys is not None else None)
+        while pending:
+            append(pending[0], *pending[1])
+            pending = next(staged, None)
+        logging.info(
+            'Committed %d changed keys, %d keys stored',
+            len(self.staged),
+            len(key_hashes)
+        )
+        self.key_hashes = key_hashes
+        self.content_hashes = content_hashes
+        self.keys = keys
+        self.seen = bytearray(len(key_hashes))
+        self.staged = {}
+
+    def save(self, path):
+        """Save committed hashes to a local file or s3://bucket/key path"""
+        parts = [
+            CONTENT_HASH_HEADER.pack(CONTENT_HASH_MAGIC, len(self), self.keys is not None),
+            _to_little_endian(self.key_hashes).tobytes(),
+            _to_little_endian(self.content_hashes).tobytes(),
+        ]
+        if self.keys is not None:
+            parts.append(serialization.dumps_bytes(self.keys))
+        write_bytes(path, b''.join(parts))
+        logging.info('Saved %d content hashes to %s', len(self), path)
+
+    @classmethod
+    def load(cls, path, keep_keys=False):
+        """Load a store saved to a local file or s3://bucket/key path.
+        Returns an empty store if nothing has been saved there yet"""
+        data = read_bytes(path)
+        store = cls(keep_keys)
+        if data:
+            magic, count, has_keys = CONTENT_HASH_HEADER.unpack_from(data)
+            if magic != CONTENT_HASH_MAGIC:
+                raise ValueError('{} is not a saved content hash store'.format(path))
+            if keep_keys and not has_keys:
+                raise ValueError('{} was saved without keys'.format(path))
+            start = CONTENT_HASH_HEADER.size
+            middle = start + count * 8
+            end = middle + count * 8
+            store.key_hashes.frombytes(data[start:middle])
+            store.content_hashes.frombytes(data[middle:end])
+            if sys.byteorder != 'little':
+                store.key_hashes.byteswap()
+                store.content_hashes.byteswap()
+            if keep_keys:
+                store.keys = serialization.loads(data[end:])
+            store.seen = bytearray(count)
+        logging.info('Loaded %d content hashes from %s', len(store), path)
+        return store
@@ -1,48 +1,124 @@
 """Elasticsearch utilities"""
 
-from elasticsearch import Elasticsearch, TransportError
+from elasticsearch import Elasticsearch, TransportError, Urllib3HttpConnection
 from elasticsearch.client import IndicesClient
-from elasticsearch.helpers import streaming_bulk
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+from collections import deque
+from urllib3.connection import HTTPConnection
 import contextlib
+import copy
+import json
 import logging
 import os
+import socket
+import threading
 import time
 import uuid
 
+from skills_utils import serialization
+from skills_utils.dedupe import ContentHashStore
+from skills_utils.hash import hash64
+
 
 HOSTNAME = os.getenv('ELASTICSEARCH_ENDPOINT', 'localhost:9200')
+POOL_SIZE = int(os.getenv('ELASTICSEARCH_POOL_SIZE', 10))
+TIMEOUT = float(os.getenv('ELASTICSEARCH_TIMEOUT', 30))
+CONNECT_ATTEMPTS = int(os.getenv('ELASTICSEARCH_CONNECT_ATTEMPTS', 6))
+MAX_CONNECT_BACKOFF = 30
+
+_clients = {}
+# Guards _client_locks. Each key has its own lock, held while its client is
+# created and the cluster waited for, so one unreachable cluster does not
+# hold up callers of other clients
+_clients_lock = threading.Lock()
+_client_locks = {}
+
+
+class KeepAliveConnection(Urllib3HttpConnection):
+    """An Elasticsearch connection whose pooled sockets use TCP keep-alive,
+    so idle connections are not silently dropped by firewalls or load balancers"""
+    def __init__(self, *args, **kwargs):
+        super(KeepAliveConnection, self).__init__(*args, **kwargs)
+        self.pool.conn_kw['socket_options'] = \
+            HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+def get_client(
+    hosts=None,
+    pool_size=None,
+    timeout=None,
+    keep_alive=True,
+    connect_attempts=None,
+    max_backoff=MAX_CONNECT_BACKOFF
+):
+    """Returns an Elasticsearch client shared by the whole process,
+    creating it on first use
+
+    Clients are cached per process and set of options, so repeated calls
+    reuse one connection pool rather than opening new connections.
+
+    Args:
+        hosts (list, optional) Defaults to the environment variable ELASTICSEARCH_ENDPOINT
+        pool_size (int, optional) The most connections kept open per host.
+            Defaults to the environment variable ELASTICSEARCH_POOL_SIZE, or 10
+        timeout (float, optional) Request timeout in seconds.
+            Defaults to the environment variable ELASTICSEARCH_TIMEOUT, or 30
+        keep_alive (bool) Whether to enable TCP keep-alive on pooled connections
+        connect_attempts (int, optional) How many times to check the cluster is
+            reachable before giving up. Defaults to the environment variable
+            ELASTICSEARCH_CONNECT_ATTEMPTS, or 6
+        max_backoff (float) The longest wait between attempts, in seconds
+
+    Returns: (Elasticsearch)
+    """
+    hosts = tuple(hosts or [HOSTNAME])
+    pool_size = pool_size or POOL_SIZE
+    timeout = timeout or TIMEOUT
+    key = (os.getpid(), hosts, pool_size, timeout, keep_alive)
+    with _clients_lock:
+        client_lock = _client_locks.setdefault(key, threading.Lock())
+    with client_lock:
+        if key not in _clients:
+            client = Elasticsearch(
+                hosts=list(hosts),
+                connection_class=KeepAliveConnection if keep_alive else Urllib3HttpConnection,
+                maxsize=pool_size,
+                timeout=timeout,
+                retry_on_timeout=True
+            )
+            _wait_for_cluster(client, connect_attempts or CONNECT_ATTEMPTS, max_backoff)
+            _clients[key] = client
+        return _clients[key]
+
+
+def _wait_for_cluster(client, attempts, max_backoff):
+    """Check that the cluster is reachable, backing off exponentially
+
+    Raises the last TransportError if it is not reachable after the given attempts
+    """
+    for attempt in range(attempts):
+        try:
+            client.info()
+            return
+        except TransportError as e:
+            if attempt == attempts - 1:
+                raise
+            backoff = min(max_backoff, 2 ** attempt)
+            logging.info('Not yet connected: %s, sleeping for %ss', e, backoff)
+            time.sleep(backoff)
 
 
 def basic_client():
     """Returns an Elasticsearch basic client that is responsive
     to the environment variable ELASTICSEARCH_ENDPOINT"""
-    es_connected = False
-    while not es_connected:
-        try:
-            ES = Elasticsearch(
-                hosts=[HOSTNAME]
-            )
-            es_connected = True
-        except TransportError as e:
-            logging.info('Not yet connected: %s, sleeping for 1s', e)
-            time.sleep(1)
-    return ES
+    return get_client()
 
 
 def indices_client():
     """Returns an Elasticsearch indices client that is responsive
-    to the environment variable ELASTICSEARCH_ENDPOINT"""
-    es_connected = False
-    while not es_connected:
-        try:
-            ES = Elasticsearch(
-                hosts=[HOSTNAME]
-            )
-            es_connected = True
-        except TransportError as e:
-            logging.info('Not yet connected: %s, sleeping for 1s', e)
-            time.sleep(1)
-    return IndicesClient(ES)
+    to the environment variable ELASTICSEARCH_ENDPOINT,
+    sharing the basic client's connections"""
+    return IndicesClient(get_client())
 
 
 def create_index(index_name, index_config, client):
@@ -100,23 +176,86 @@ def atomic_swap(alias_name, new_index_name, index_client):
         index_client.update_aliases(body=actions)
 
 
+def _bulk_load_settings(index_config):
+    """Split an index configuration into one suited to bulk loading, and the
+    settings to restore once loading is done
+
+    Args:
+        index_config (dict) Configuration for the new index
+
+    Returns: (tuple) The bulk-load configuration and the settings to restore
+    """
+    index_config = copy.deepcopy(index_config)
+    settings = index_config.setdefault('settings', {})
+    if isinstance(settings.get('index'), dict):
+        target = settings['index']
+    else:
+        target = settings
+    restore = {'refresh_interval': '1s', 'number_of_replicas': 1}
+    for name in restore:
+        for container, key in ((settings, 'index.' + name), (settings, name), (target, name)):
+            if key in container:
+                restore[name] = container.pop(key)
+    target['refresh_interval'] = '-1'
+    target['number_of_replicas'] = 0
+    return index_config, {'index': restore}
+
+
 @contextlib.contextmanager
-def zero_downtime_index(index_name, index_config):
+def zero_downtime_index(
+    index_name,
+    index_config,
+    bulk_load=False,
+    max_num_segments=None,
+    wait_for_status='green',
+    timeout='30m'
+):
     """Context manager to create a new index based on a given alias,
     allow the caller to index it, and then point the alias to the new index
 
     Args:
         index_name (str) Name of an alias that should point to the new index
         index_config (dict) Configuration for the new index
+        bulk_load (bool) Whether to create the index without refreshes or
+            replicas, restoring the configured settings after indexing
+        max_num_segments (int, optional) If given, force merge the new index
+            down to this many segments before swapping
+        wait_for_status (str) In bulk-load mode, the cluster health status
+            the new index must reach before swapping
+        timeout (str) How long to wait for that status
 
     Yields: (name) The full name of the new index
     """
     client = indices_client()
     temporary_name = index_name + '_' + str(uuid.uuid4())
+    if bulk_load:
+        index_config, restore_settings = _bulk_load_settings(index_config)
     logging.info('creating index with config %s', index_config)
     create_index(temporary_name, index_config, client)
     try:
         yield temporary_name
+        if bulk_load:
+            logging.info('restoring settings %s', restore_settings)
+            client.put_settings(index=temporary_name, body=restore_settings)
+            client.refresh(index=temporary_name)
+        if max_num_segments:
+            logging.info('force merging to %d segments', max_num_segments)
+            client.forcemerge(
+                index=temporary_name,
+                max_num_segments=max_num_segments,
+                request_timeout=3600
+            )
+        if bulk_load:
+            health = client.client.cluster.health(
+                index=temporary_name,
+                wait_for_status=wait_for_status,
+                timeout=timeout
+            )
+            if health.get('timed_out'):
+                raise ValueError('Index {} did not reach {} status'.format(
+                    temporary_name,
+                    wait_for_status
+                ))
         atomic_swap(index_name, temporary_name, client)
     except Exception:
         logging.error(
@@ -128,6 +267,35 @@ def zero_downtime_index(index_name, index_config):
 
 
 class ElasticsearchIndexerBase(object):
+    # Bulk requests are bounded by both document count and request bytes
+    BULK_CHUNK_SIZE = 500
+    BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024
+    # More than one thread sends bulk requests concurrently, with at most
+    # BULK_QUEUE_SIZE chunks waiting for a thread
+    BULK_THREADS = 1
+    BULK_QUEUE_SIZE = 4
+    # Load new indexes without refreshes or replicas, see zero_downtime_index
+    BULK_LOAD = False
+    FORCE_MERGE_SEGMENTS = None
+    BULK_LOAD_WAIT_FOR_STATUS = 'green'
+    # Documents rejected with a transient error are fed back into the bulk
+    # stream once their exponential backoff has passed. While more than
+    # BULK_MAX_PENDING_RETRIES wait, no new documents are read, and any left
+    # at the end are retried in shrinking chunks
+    BULK_MAX_PENDING_RETRIES = 10000
+    BULK_MAX_RETRIES = 0
+    BULK_INITIAL_BACKOFF = 2
+    BULK_MAX_BACKOFF = 600
+    BULK_MIN_CHUNK_SIZE = 10
+    BULK_RETRY_STATUSES = (429, 502, 503, 504)
+    # Documents that still fail are appended to this JSON lines file
+    DEAD_LETTER_PATH = None
+    # Remember a hash of each document's content here (a local or s3:// path)
+    # so append only sends new or changed documents, and optionally deletes
+    # documents that are no longer produced
+    DELTA_STORE_PATH = None
+    DELTA_DELETES = False
+
     def __init__(self, s3_conn, es_client):
         """
         Base class for Elasticsearch indexers
@@ -155,35 +323,278 @@ class ElasticsearchIndexerBase(object):
         """Replace index with a new one
         zero_downtime_index for safety and rollback
         """
-        with zero_downtime_index(self.alias_name, self.index_config()) as target_index:
-            self.index_all(target_index)
+        store = None
+        if self.DELTA_STORE_PATH:
+            store = ContentHashStore(keep_keys=self.DELTA_DELETES)
+        with zero_downtime_index(
+            self.alias_name,
+            self.index_config(),
+            bulk_load=self.BULK_LOAD,
+            max_num_segments=self.FORCE_MERGE_SEGMENTS,
+            wait_for_status=self.BULK_LOAD_WAIT_FOR_STATUS
+        ) as target_index:
+            if store is None:
+                self.index_all(target_index)
+            else:
+                self._index_delta(target_index, store)
+        if store is not None and get_index_from_alias(self.alias_name) == target_index:
+            store.save(self.DELTA_STORE_PATH)
 
     def append(self):
         """Index documents onto an existing index"""
         target_index = get_index_from_alias(self.alias_name)
         if not target_index:
             self.replace()
+        elif self.DELTA_STORE_PATH:
+            self.index_delta(target_index)
         else:
             self.index_all(target_index)
 
     def index_all(self, index_name):
-        """Index all available documents, using streaming_bulk for speed
+        """Index all available documents, using streaming_bulk for speed,
+        or parallel_bulk if BULK_THREADS is more than one
+
+        Args:
+            index_name (string): The index
+
+        Returns: (tuple) The number of documents indexed and not indexed
+        """
+        return self._index_actions(self._iter_documents(index_name))
+
+    def replay_dead_letters(self, path, index_name=None):
+        """Index the documents recorded in a dead-letter file again
+
         Args:
+            path (str) A file previously written to DEAD_LETTER_PATH
+            index_name (str, optional) An index to send the documents to,
+                instead of the one they were originally sent to
 
-        index_name (string): The index
+        Returns: (tuple) The number of documents indexed and not indexed
         """
-        oks = 0
-        notoks = 0
-        for ok, item in streaming_bulk(
-            self.es_client,
-            self._iter_documents(index_name)
-        ):
-            if ok:
-                oks += 1
+        if self.DEAD_LETTER_PATH and \
+                os.path.abspath(path) == os.path.abspath(self.DEAD_LETTER_PATH):
+            raise ValueError('Move the dead-letter file before replaying it')
+
+        def actions():
+            with open(path, 'rb') as f:
+                for line in f:
+                    action = serialization.loads(line)['action']
+                    if index_name:
+                        action['_index'] = index_name
+                    yield action
+
+        return self._index_actions(actions())
+
+    def index_delta(self, index_name):
+        """Index only documents that are new or changed since the last delta
+        run, according to the content hashes stored at DELTA_STORE_PATH.
+        Documents must have an _id.
+
+        With DELTA_DELETES, documents indexed before but no longer yielded
+        by _iter_documents are deleted.
+
+        Args:
+            index_name (string): The index
+
+        Returns: (tuple) The number of documents indexed and not indexed
+        """
+        store = ContentHashStore.load(self.DELTA_STORE_PATH, keep_keys=self.DELTA_DELETES)
+        result = self._index_delta(index_name, store)
+        store.save(self.DELTA_STORE_PATH)
+        return result
+
+    def _index_delta(self, index_name, store):
+        """Index changed documents and commit their hashes to the store"""
+        doc_types = set()
+
+        def changed_actions():
+            skipped = 0
+            for action in self._iter_documents(index_name):
+                if '_type' in action:
+                    doc_types.add(action['_type'])
+                if store.stage(action['_id'], self._content_hash(action)):
+                    yield action
+                else:
+                    skipped += 1
+            logging.info('Skipped %d unchanged documents', skipped)
+            if self.DELTA_DELETES:
+                doc_type = doc_types.pop() if len(doc_types) == 1 else '_doc'
+                for document_id in store.unseen():
+                    yield {
+                        '_op_type': 'delete',
+                        '_index': index_name,
+                        '_type': doc_type,
+                        '_id': document_id,
+                    }
+
+        def on_failure(action, info):
+            if action.get('_op_type') != 'delete':
+                store.unstage(action['_id'])
             else:
-                notoks += 1
+                store.keep(action['_id'])
+
+        result = self._index_actions(changed_actions(), on_failure)
+        store.commit(drop_unseen=self.DELTA_DELETES)
+        return result
+
+    def _content_hash(self, action):
+        """A 64-bit hash of a document's content, independent of the index
+        it is being sent to
+
+        Args:
+            action (dict) A bulk action, as yielded by _iter_documents
+
+        Returns: (int)
+        """
+        # canonical JSON, so equal documents hash the same whatever their key order
+        return hash64(json.dumps(
+            {key: value for key, value in action.items() if key != '_index'},
+            sort_keys=True,
+            separators=(',', ':'),
+            default=str
+        ))
+
+    def _index_actions(self, actions, on_failure=None):
+        """Send bulk actions, retrying transient failures and recording
+        the rest in the dead-letter file
+
+        Args:
+            actions (iterable) Bulk actions, as yielded by _iter_documents
+            on_failure (function, optional) Called with each action that
+                finally failed, and its result
+
+        Returns: (tuple) The number of documents indexed and not indexed
+        """
+        counts = {'ok': 0, 'not ok': 0, 'retries': 0}
+        start = time.time()
+        dead_letters = open(self.DEAD_LETTER_PATH, 'ab') if self.DEAD_LETTER_PATH else None
+        # (time it may be sent, action) for each rejected action to retry, and
+        # how many times each of those has been attempted
+        retries = deque()
+        attempts = {}
+
+        def fail(action, info):
+            counts['not ok'] += 1
+            logging.debug('Document failed to index: %s', info)
+            if on_failure:
+                on_failure(action, info)
+            if dead_letters:
+                # the client's serializer handles everything it could send,
+                # such as dates and Decimals
+                dead_letters.write(self.es_client.transport.serializer.dumps({
+                    'action': action,
+                    'status': info.get('status'),
+                    'error': str(info.get('error')),
+                }).encode('utf-8') + b'\n')
+
+        def collect(results):
+            for ok, item, action in results:
+                attempt = attempts.pop(id(action), 0) + 1
+                op_type, info = next(iter(item.items()))
+                # a document to delete that is already missing is no failure
+                if ok or (op_type == 'delete' and info.get('status') == 404):
+                    counts['ok'] += 1
+                    continue
+                if attempt > self.BULK_MAX_RETRIES or not self._is_transient(info):
+                    fail(action, info)
+                    continue
+                counts['retries'] += 1
+                attempts[id(action)] = attempt
+                retries.append((time.time() + self._backoff(attempt), action))
+
+        def with_retries(actions):
+            # runs in parallel_bulk's own thread when BULK_THREADS > 1
+            for action in actions:
+                while retries and (
+                    len(retries) >= self.BULK_MAX_PENDING_RETRIES or
+                    retries[0][0] <= time.time()
+                ):
+                    send_at, retry = retries.popleft()
+                    time.sleep(max(0, send_at - time.time()))
+                    yield retry
+                yield action
+
+        try:
+            if self.BULK_MAX_RETRIES:
+                actions = with_retries(actions)
+            collect(self._bulk(actions, self.BULK_CHUNK_SIZE))
+            chunk_size = self.BULK_CHUNK_SIZE
+            while retries:
+                chunk_size = max(self.BULK_MIN_CHUNK_SIZE, chunk_size // 2)
+                pending = list(retries)
+                retries.clear()
+                delay = max(send_at for send_at, _ in pending) - time.time()
+                logging.warning(
+                    'Retrying %d rejected documents in chunks of %d after %.1fs',
+                    len(pending),
+                    chunk_size,
+                    max(0, delay)
+                )
+                time.sleep(max(0, delay))
+                collect(self._bulk([action for _, action in pending], chunk_size))
+        finally:
+            if dead_letters:
+                dead_letters.close()
+        elapsed = time.time() - start
         logging.info(
-            "Import results: %d ok, %d not ok",
-            oks,
-            notoks
+            "Import results: %d ok, %d not ok, %d retries, %.1f docs/sec",
+            counts['ok'],
+            counts['not ok'],
+            counts['retries'],
+            (counts['ok'] + counts['not ok']) / elapsed if elapsed else 0
         )
+        if counts['not ok'] and not dead_letters:
+            logging.warning(
+                '%d documents could not be indexed and were dropped. '
+                'Set DEAD_LETTER_PATH to keep them for replay_dead_letters',
+                counts['not ok']
+            )
+        return counts['ok'], counts['not ok']
+
+    def _backoff(self, attempt):
+        """Returns: (float) seconds to wait before the given retry, starting at 1"""
+        return min(self.BULK_MAX_BACKOFF, self.BULK_INITIAL_BACKOFF * 2 ** (attempt - 1))
+
+    def _is_transient(self, info):
+        """Whether a failed bulk item is worth retrying
+
+        Connection errors, which have no HTTP status, are considered transient
+        """
+        status = info.get('status')
+        return not isinstance(status, int) or status in self.BULK_RETRY_STATUSES
+
+    def _bulk(self, actions, chunk_size):
+        """Send actions to Elasticsearch in chunks, without raising on failures
+
+        Args:
+            actions (iterable) Bulk actions, as yielded by _iter_documents
+            chunk_size (int) The most actions to send in one request
+
+        Yields: (tuple) Whether each action succeeded, its result, and the action
+        """
+        sent = deque()
+
+        def track(actions):
+            for action in actions:
+                sent.append(action)
+                yield action
+
+        kwargs = {
+            'chunk_size': chunk_size,
+            'max_chunk_bytes': self.BULK_MAX_CHUNK_BYTES,
+            'raise_on_error': False,
+            'raise_on_exception': False,
+        }
+        if self.BULK_THREADS > 1:
+            results = parallel_bulk(
+                self.es_client,
+                track(actions),
+                thread_count=self.BULK_THREADS,
+                queue_size=self.BULK_QUEUE_SIZE,
+                **kwargs
+            )
+        else:
+            results = streaming_bulk(self.es_client, track(actions), **kwargs)
+        # both helpers report results in the order actions were sent
+        for ok, item in results:
+            yield ok, item, sent.popleft()
@@ -0,0 +1,243 @@
+"""Asyncio Elasticsearch utilities, mirroring those in skills_utils.es
+
+Requires elasticsearch-py 7.8 or later with the async extra
+(pip install elasticsearch[async])
+"""
+import contextlib
+import logging
+import time
+import uuid
+
+try:
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch.helpers import async_streaming_bulk
+except ImportError:
+    AsyncElasticsearch = None
+    async_streaming_bulk = None
+
+from skills_utils.es import HOSTNAME, POOL_SIZE, TIMEOUT, _bulk_load_settings
+from skills_utils.iteration import aprefetch
+
+
+def async_client(hosts=None, pool_size=None, timeout=None):
+    """Returns an AsyncElasticsearch client that is responsive
+    to the environment variable ELASTICSEARCH_ENDPOINT
+
+    The client is bound to the running event loop; close it when done.
+
+    Args:
+        hosts (list, optional) Defaults to the environment variable ELASTICSEARCH_ENDPOINT
+        pool_size (int, optional) The most connections kept open per host
+        timeout (float, optional) Request timeout in seconds
+
+    Returns: (AsyncElasticsearch)
+    """
+    if AsyncElasticsearch is None:
+        raise ValueError('Async indexing requires elasticsearch[async] 7.8 or later')
+    return AsyncElasticsearch(
+        hosts=hosts or [HOSTNAME],
+        maxsize=pool_size or POOL_SIZE,
+        timeout=timeout or TIMEOUT,
+        retry_on_timeout=True
+    )
+
+
+async def get_index_from_alias(alias_name, client):
+    """Retrieve the base index name from an alias
+
+    Args:
+        alias_name (str) Name of the alias
+        client (AsyncElasticsearch) an Elasticsearch client
+
+    Returns: (str) Name of index
+    """
+    if not await client.indices.exists_alias(name=alias_name):
+        return None
+    return list((await client.indices.get_alias(name=alias_name)).keys())[0]
+
+
+async def atomic_swap(alias_name, new_index_name, client):
+    """Points an alias to a new index, then delete the old index if needed
+
+    Args:
+        alias_name (str) Name of the alias
+        new_index_name (str) The new index that the alias should point to
+        client (AsyncElasticsearch) an Elasticsearch client
+    """
+    logging.info('Performing atomic index alias swap')
+    old_index_name = await get_index_from_alias(alias_name, client)
+    actions = [{'add': {'index': new_index_name, 'alias': alias_name}}]
+    if old_index_name:
+        logging.info('Removing old as well as adding new')
+        actions.insert(0, {'remove': {'index': old_index_name, 'alias': alias_name}})
+    else:
+        logging.info('Old alias not found, only adding new')
+    await client.indices.update_aliases(body={'actions': actions})
+    if old_index_name:
+        await client.indices.delete(index=old_index_name)
+
+
+@contextlib.asynccontextmanager
+async def zero_downtime_index(
+    index_name,
+    index_config,
+    client,
+    bulk_load=False,
+    max_num_segments=None,
+    wait_for_status='green',
+    timeout='30m'
+):
+    """Async context manager to create a new index based on a given alias,
+    allow the caller to index it, and then point the alias to the new index.
+    See skills_utils.es.zero_downtime_index
+
+    Args:
+        index_name (str) Name of an alias that should point to the new index
+        index_config (dict) Configuration for the new index
+        client (AsyncElasticsearch) an Elasticsearch client
+        bulk_load (bool) Whether to create the index without refreshes or
+            replicas, restoring the configured settings after indexing
+        max_num_segments (int, optional) If given, force merge the new index
+            down to this many segments before swapping
+        wait_for_status (str) In bulk-load mode, the cluster health status
+            the new index must reach before swapping
+        timeout (str) How long to wait for that status
+
+    Yields: (name) The full name of the new index
+    """
+    temporary_name = index_name + '_' + str(uuid.uuid4())
+    if bulk_load:
+        index_config, restore_settings = _bulk_load_settings(index_config)
+    logging.info('creating index with config %s', index_config)
+    await client.indices.create(index=temporary_name, body=index_config)
+    try:
+        yield temporary_name
+        if bulk_load:
+            logging.info('restoring settings %s', restore_settings)
+            await client.indices.put_settings(index=temporary_name, body=restore_settings)
+            await client.indices.refresh(index=temporary_name)
+        if max_num_segments:
+            logging.info('force merging to %d segments', max_num_segments)
+            await client.indices.forcemerge(
+                index=temporary_name,
+                max_num_segments=max_num_segments,
+                request_timeout=3600
+            )
+        if bulk_load:
+            health = await client.cluster.health(
+                index=temporary_name,
+                wait_for_status=wait_for_status,
+                timeout=timeout
+            )
+            if health.get('timed_out'):
+                raise ValueError('Index {} did not reach {} status'.format(
+                    temporary_name,
+                    wait_for_status
+                ))
+        await atomic_swap(index_name, temporary_name, client)
+    except Exception:
+        logging.error(
+            'deleting temporary index %s due to error:',
+            temporary_name,
+            exc_info=True
+        )
+        await client.indices.delete(index=temporary_name)
+
+
+class AsyncElasticsearchIndexerBase(object):
+    # See ElasticsearchIndexerBase
+    BULK_CHUNK_SIZE = 500
+    BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024
+    BULK_LOAD = False
+    FORCE_MERGE_SEGMENTS = None
+    BULK_LOAD_WAIT_FOR_STATUS = 'green'
+    # Documents rejected with 429 are retried, with exponential backoff
+    BULK_MAX_RETRIES = 0
+    BULK_INITIAL_BACKOFF = 2
+    BULK_MAX_BACKOFF = 600
+    # How many documents to produce ahead of the bulk requests
+    PREFETCH = 1000
+
+    def __init__(self, s3_conn, es_client):
+        """
+        Base class for asyncio Elasticsearch indexers
+
+        Like ElasticsearchIndexerBase, but index_all, replace and append
+        are coroutines, and _iter_documents may be either a generator or an
+        async generator. Documents are produced concurrently with bulk requests.
+
+        Args:
+            s3_conn - a boto s3 connection
+            es_client - an AsyncElasticsearch client
+        """
+        self.s3_conn = s3_conn
+        self.es_client = es_client
+
+    def index_config(self):
+        """Combines setting and mapping config into a full index configuration
+        Returns: dict
+        """
+        return {
+            'settings': self.settings,
+            'mappings': self.mappings
+        }
+
+    async def replace(self):
+        """Replace index with a new one
+        zero_downtime_index for safety and rollback
+        """
+        async with zero_downtime_index(
+            self.alias_name,
+            self.index_config(),
+            self.es_client,
+            bulk_load=self.BULK_LOAD,
+            max_num_segments=self.FORCE_MERGE_SEGMENTS,
+            wait_for_status=self.BULK_LOAD_WAIT_FOR_STATUS
+        ) as target_index:
+            await self.index_all(target_index)
+
+    async def append(self):
+        """Index documents onto an existing index"""
+        target_index = await get_index_from_alias(self.alias_name, self.es_client)
+        if not target_index:
+            await self.replace()
+        else:
+            await self.index_all(target_index)
+
+    async def index_all(self, index_name):
+        """Index all available documents, using async_streaming_bulk
+
+        Args:
+            index_name (string): The index
+
+        Returns: (tuple) The number of documents indexed and not indexed
+        """
+        if async_streaming_bulk is None:
+            raise ValueError('Async indexing requires elasticsearch[async] 7.8 or later')
+        oks = 0
+        notoks = 0
+        start = time.time()
+        async for ok, item in async_streaming_bulk(
+            self.es_client,
+            aprefetch(self._iter_documents(index_name), self.PREFETCH),
+            chunk_size=self.BULK_CHUNK_SIZE,
+            max_chunk_bytes=self.BULK_MAX_CHUNK_BYTES,
+            raise_on_error=False,
+            raise_on_exception=False,
+            max_retries=self.BULK_MAX_RETRIES,
+            initial_backoff=self.BULK_INITIAL_BACKOFF,
+            max_backoff=self.BULK_MAX_BACKOFF,
+        ):
+            if ok:
+                oks += 1
+            else:
+                notoks += 1
+                logging.debug('Document failed to index: %s', item)
+        elapsed = time.time() - start
+        logging.info(
+            "Import results: %d ok, %d not ok, %.1f docs/sec",
+            oks,
+            notoks,
+            (oks + notoks) / elapsed if elapsed else 0
+        )
+        return oks, notoks
@@ -2,9 +2,13 @@
 
 from functools import wraps
 import os
-import json
+
+import s3fs
+
+from skills_utils import serialization
 
 CACHE_DIRECTORY = 'tmp/'
+S3_SCHEME = 's3://'
 
 
 def cache_json(filename):
@@ -21,12 +25,12 @@ def cache_json(filename):
             path = CACHE_DIRECTORY + filename
             check_create_folder(path)
             if os.path.exists(path):
-                with open(path) as infile:
-                    return json.load(infile)
+                with open(path, 'rb') as infile:
+                    return serialization.loads(infile.read())
             else:
                 function_output = cacheable_function(*args, **kwargs)
-                with open(path, 'w') as outfile:
-                    json.dump(function_output, outfile)
+                with open(path, 'wb') as outfile:
+                    outfile.write(serialization.dumps_bytes(function_output))
                 return function_output
         return cache_wrapper
     return cache_decorator
@@ -35,3 +39,44 @@ def cache_json(filename):
 def check_create_folder(filename):
     """Check if the folder exisits. If not, create the folder"""
     os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+
+def read_bytes(path):
+    """Read the contents of a local file or, if the path starts with s3://, an S3 object
+
+    Args:
+        path (str) A local filename or s3://bucket/key path
+
+    Returns: (bytes) the contents, or None if the file does not exist
+    """
+    if path.startswith(S3_SCHEME):
+        fs = s3fs.S3FileSystem()
+        if not fs.exists(path[len(S3_SCHEME):]):
+            return None
+        with fs.open(path[len(S3_SCHEME):], 'rb') as f:
+            return f.read()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_bytes(path, data):
+    """Replace the contents of a local file or, if the path starts with s3://,
+    an S3 object. Local files are replaced atomically, so readers never
+    see a partially written file
+
+    Args:
+        path (str) A local filename or s3://bucket/key path
+        data (bytes) The new contents
+    """
+    if path.startswith(S3_SCHEME):
+        with s3fs.S3FileSystem().open(path[len(S3_SCHEME):], 'wb') as f:
+            f.write(data)
+        return
+    if os.path.dirname(path):
+        check_create_folder(path)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_path, path)
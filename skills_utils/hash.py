@@ -10,3 +10,18 @@ def md5(string):
     Returns: (str) the md5 hash
     """
     return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+
+def hash64(string):
+    """Returns a 64-bit hash of a string, for use where compactness matters
+    more than collision resistance (e.g. sets of millions of ids)
+
+    Args:
+        string (str) any string
+
+    Returns: (int) an unsigned 64-bit integer
+    """
+    return int.from_bytes(
+        hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(),
+        'little'
+    )
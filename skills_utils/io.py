@@ -1,21 +1,688 @@
 """I/O utilities"""
-import json
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+import asyncio
+import bz2
+import gzip
+import inspect
 import logging
+import os
+import queue
+import sys
+import time
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def stream_json_file(local_file):
+from skills_utils import serialization
+from skills_utils.common import safe_get
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+INDEX_SUFFIX = '.idx'
+MANIFEST_FILENAME = 'manifest.json'
+
+COMPRESSORS = {
+    None: ('', lambda data, level: data),
+    'gzip': ('.gz', lambda data, level: gzip.compress(data, level)),
+    'bz2': ('.bz2', lambda data, level: bz2.compress(data, level)),
+}
+
+
+def stream_json_file(local_file, processes=None, ordered=True, chunk_size=DEFAULT_CHUNK_SIZE):
     """Stream a JSON file (in JSON-per-line format)
 
     Args:
         local_file (file-like object) an open file-handle that contains a
-            JSON string on each line
+            JSON string on each line. Wrap compressed or very large files
+            in open_json_lines for transparent decompression and buffering
+        processes (int, optional) If given, decode lines in a pool of this
+            many worker processes instead of in the calling process.
+            The file is read in large chunks, which requires a .read method
+        ordered (bool) In parallel mode, whether to yield objects in file
+            order. Unordered mode yields each chunk as soon as it is decoded
+        chunk_size (int) In parallel mode, approximate number of bytes
+            sent to a worker at a time
+    Yields:
+        (dict) JSON objects
+    """
+    if processes:
+        yield from _stream_json_file_parallel(local_file, processes, ordered, chunk_size)
+        return
+    yield from _decode_lines(local_file)
+
+
+async def astream_json_file(local_file, block_size=DEFAULT_BLOCK_SIZE):
+    """Asynchronously stream a JSON file (in JSON-per-line format)
+
+        async for posting in astream_json_file(local_file):
+            do_stuff(posting)
+
+    Args:
+        local_file (file-like object) an open binary file-handle. If its read
+            method is a coroutine function (e.g. aiofiles) it is awaited,
+            otherwise reads happen in the default executor
+        block_size (int) How many bytes to read at a time
     Yields:
         (dict) JSON objects
     """
-    for i, line in enumerate(local_file):
+    if inspect.iscoroutinefunction(local_file.read):
+        read = local_file.read
+    else:
+        loop = asyncio.get_running_loop()
+
+        def read(size):
+            return loop.run_in_executor(None, local_file.read, size)
+
+    line_number = 0
+    remainder = b''
+    while True:
+        block = await read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        for data in _decode_lines(lines, line_number):
+            yield data
+        line_number += len(lines)
+    if remainder:
+        for data in _decode_lines([remainder], line_number):
+            yield data
+
+
+def stream_json_projection(local_file, fields, processes=None, ordered=True,
+                           chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream only selected values from a JSON file (in JSON-per-line format)
+
+    Each line is decoded and immediately reduced to the requested values, so
+    the full object is never held onto or, in parallel mode, sent between processes.
+
+    Args:
+        local_file (file-like object) an open file-handle that contains a
+            JSON string on each line
+        fields (list|dict) Key paths to extract. Each is a key, or a list or
+            tuple of keys in the form accepted by common.safe_get. If a dict,
+            maps output names to key paths
+        processes, ordered, chunk_size: as in stream_json_file
+    Yields:
+        (tuple) the extracted values, in the order of fields, or (dict) if
+            fields was a dict. Missing keys produce None
+    """
+    if isinstance(fields, dict):
+        names = list(fields.keys())
+        paths = _key_paths(fields.values())
+    else:
+        names = None
+        paths = _key_paths(fields)
+    if processes:
+        values = _stream_json_file_parallel(local_file, processes, ordered, chunk_size, paths)
+    else:
+        values = _decode_lines(local_file, paths=paths)
+    if names is None:
+        yield from values
+    else:
+        for row in values:
+            yield dict(zip(names, row))
+
+
+def _key_paths(fields):
+    """Normalize a list of keys or key lists into a tuple of key tuples"""
+    return tuple(
+        tuple(field) if isinstance(field, (list, tuple)) else (field,)
+        for field in fields
+    )
+
+
+def _project(data, paths):
+    """Extract the values at each key path from a decoded object"""
+    return tuple(safe_get(data, *path) for path in paths)
+
+
+def _decode_lines(lines, first_line=0, paths=None):
+    """Decode JSON lines, logging and skipping the ones that are malformed
+
+    Args:
+        lines (iterable) bytes, each containing a JSON string
+        first_line (int) The line number of the first line, for logging
+        paths (tuple, optional) Key paths to project each object onto
+
+    Yields:
+        (dict) JSON objects, or (tuple) projected values if paths were given
+    """
+    loads = serialization.loads
+    for i, line in enumerate(lines, first_line):
         try:
-            data = json.loads(line.decode('utf-8'))
+            data = loads(line)
+            if paths is not None:
+                data = _project(data, paths)
             yield data
         except ValueError as e:
             logging.warning("Skipping line %d due to error: %s", i, e)
             continue
+
+
+def _read_line_chunks(local_file, chunk_size):
+    """Read a file in chunks that end on line boundaries
+
+    Args:
+        local_file (file-like object) an open binary file-handle
+        chunk_size (int) approximate number of bytes per chunk
+
+    Yields:
+        (tuple) the line number of the first line in the chunk, and the chunk
+    """
+    line_number = 0
+    remainder = b''
+    while True:
+        block = local_file.read(chunk_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            remainder = block
+            continue
+        chunk, remainder = block[:cut], block[cut:]
+        yield line_number, chunk
+        line_number += chunk.count(b'\n')
+    if remainder:
+        yield line_number, remainder
+
+
+def _decode_chunk(numbered_chunk, paths=None):
+    """Decode every line in a chunk of JSON lines. Runs in a worker process
+
+    Args:
+        numbered_chunk (tuple) the line number of the first line, and the chunk
+        paths (tuple, optional) Key paths to project each object onto
+
+    Returns: (tuple) a list of decoded objects, and a list of
+        (line number, error message) tuples for lines that could not be decoded
+    """
+    first_line, chunk = numbered_chunk
+    lines = chunk.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    decoded = []
+    errors = []
+    loads = serialization.loads
+    for i, line in enumerate(lines, first_line):
+        try:
+            data = loads(line)
+            decoded.append(data if paths is None else _project(data, paths))
+        except ValueError as e:
+            errors.append((i, str(e)))
+    return decoded, errors
+
+
+def _stream_json_file_parallel(local_file, processes, ordered, chunk_size, paths=None):
+    """Stream a JSON-per-line file, decoding chunks in a process pool
+
+    At most two chunks per process are read ahead of the consumer, so memory
+    use stays bounded regardless of file size.
+    """
+    max_in_flight = 2 * processes
+    with Pool(processes) as pool:
+        chunks = _read_line_chunks(local_file, chunk_size)
+        if ordered:
+            results = _decode_ordered(pool, chunks, max_in_flight, paths)
+        else:
+            results = _decode_unordered(pool, chunks, max_in_flight, paths)
+        for decoded, errors in results:
+            for i, message in errors:
+                logging.warning("Skipping line %d due to error: %s", i, message)
+            yield from decoded
+
+
+def _decode_ordered(pool, chunks, max_in_flight, paths):
+    """Yield decoded chunks in the order they were read"""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_decode_chunk, (chunk, paths)))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _decode_unordered(pool, chunks, max_in_flight, paths):
+    """Yield decoded chunks as soon as any worker finishes one"""
+    finished = queue.Queue()
+    in_flight = 0
+    for chunk in chunks:
+        pool.apply_async(
+            _decode_chunk,
+            (chunk, paths),
+            callback=lambda result: finished.put((True, result)),
+            error_callback=lambda error: finished.put((False, error)),
+        )
+        in_flight += 1
+        if in_flight >= max_in_flight:
+            yield _get_decoded(finished)
+            in_flight -= 1
+    while in_flight:
+        yield _get_decoded(finished)
+        in_flight -= 1
+
+
+def _get_decoded(finished):
+    """Take the next result off of a queue filled by pool callbacks,
+    re-raising any exception raised in the worker"""
+    succeeded, result = finished.get()
+    if not succeeded:
+        raise result
+    return result
+
+
+def open_json_lines(local_file, block_size=DEFAULT_BLOCK_SIZE, log_interval=60):
+    """Open a possibly-compressed JSON-per-line file for fast streaming
+
+    Compression (gzip, bz2 or zstd) is detected from the first bytes of the file.
+
+    Args:
+        local_file (file-like object) an open binary file-handle
+        block_size (int) How many decompressed bytes to read at a time
+        log_interval (int) How often, in seconds, to log throughput
+
+    Returns: (BlockLineReader) suitable for passing to stream_json_file
+    """
+    return BlockLineReader(decompressed(local_file), block_size, log_interval)
+
+
+def decompressed(local_file):
+    """Wrap a binary file-handle in a decompressing reader if its contents
+    start with a gzip, bz2 or zstd magic number
+
+    Args:
+        local_file (file-like object) an open binary file-handle
+
+    Returns: (file-like object) the decompressed stream
+    """
+    magic = local_file.read(len(ZSTD_MAGIC))
+    local_file = _PrefixedReader(magic, local_file)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=local_file, mode='rb')
+    if magic.startswith(BZ2_MAGIC):
+        return bz2.BZ2File(local_file, mode='rb')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError('zstd-compressed input requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(
+            local_file,
+            read_across_frames=True
+        )
+    return local_file
+
+
+class _PrefixedReader(object):
+    """A minimal readable stream that replays already-consumed bytes
+    before continuing with the rest of a file-handle"""
+    def __init__(self, prefix, local_file):
+        self.prefix = prefix
+        self.local_file = local_file
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.local_file.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.local_file.read()
+            self.prefix = b''
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.local_file.read(size - len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.local_file.close()
+
+
+class BlockLineReader(object):
+    """Splits a binary stream into lines using large block reads instead of
+    per-line iteration, and keeps track of ingest throughput
+
+    Args:
+        local_file (file-like object) a readable binary stream
+        block_size (int) How many bytes to read at a time
+        log_interval (int) How often, in seconds, to log throughput.
+            Pass None to disable periodic logging
+    """
+    def __init__(self, local_file, block_size=DEFAULT_BLOCK_SIZE, log_interval=60):
+        self.local_file = local_file
+        self.block_size = block_size
+        self.log_interval = log_interval
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.start_time = time.time()
+        self.last_logged = self.start_time
+
+    def _read_block(self, size):
+        block = self.local_file.read(size)
+        self.bytes_read += len(block)
+        if self.log_interval is not None:
+            if not block or time.time() - self.last_logged >= self.log_interval:
+                self.log_throughput()
+        return block
+
+    def read(self, size=-1):
+        """Read bytes from the underlying stream, bypassing line splitting
+
+        Provided so a BlockLineReader can feed stream_json_file's parallel mode
+        """
+        if size is None or size < 0:
+            size = -1
+        block = self._read_block(size)
+        self.lines_read += block.count(b'\n')
+        return block
+
+    def __iter__(self):
+        """Yield lines (without their trailing newline) from the stream"""
+        remainder = b''
+        while True:
+            block = self._read_block(self.block_size)
+            if not block:
+                break
+            lines = (remainder + block).split(b'\n')
+            remainder = lines.pop()
+            self.lines_read += len(lines)
+            yield from lines
+        if remainder:
+            self.lines_read += 1
+            yield remainder
+
+    @property
+    def elapsed(self):
+        return max(time.time() - self.start_time, 1e-9)
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_read / self.elapsed
+
+    @property
+    def lines_per_second(self):
+        return self.lines_read / self.elapsed
+
+    def log_throughput(self):
+        """Log the bytes and lines processed so far, and their rates"""
+        self.last_logged = time.time()
+        logging.info(
+            'Read %d bytes (%.0f bytes/sec) and %d lines (%.0f lines/sec)',
+            self.bytes_read,
+            self.bytes_per_second,
+            self.lines_read,
+            self.lines_per_second
+        )
+
+    def close(self):
+        self.local_file.close()
+
+
+class _BoundedReader(object):
+    """A readable stream that stops after a given number of bytes"""
+    def __init__(self, local_file, limit):
+        self.local_file = local_file
+        self.remaining = limit
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.local_file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def build_line_index(path, index_path=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Write a sidecar index of line offsets for an uncompressed JSON-per-line file
+
+    The index is a flat array of little-endian uint64 byte offsets: the start
+    of every line, followed by the size of the file.
+
+    Args:
+        path (str) The JSON-per-line file
+        index_path (str, optional) Where to write the index.
+            Defaults to the path plus INDEX_SUFFIX
+        block_size (int) How many bytes to scan at a time
+
+    Returns: (LineIndex) the new index
+    """
+    index_path = index_path or path + INDEX_SUFFIX
+    offsets = array('Q', [0])
+    position = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newline = block.find(b'\n')
+            while newline >= 0:
+                offsets.append(position + newline + 1)
+                newline = block.find(b'\n', newline + 1)
+            position += len(block)
+    if offsets[-1] != position:
+        offsets.append(position)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    with open(index_path, 'wb') as f:
+        offsets.tofile(f)
+    logging.info('Indexed %d lines of %s', len(offsets) - 1, path)
+    return LineIndex(path, index_path)
+
+
+class LineIndex(object):
+    """Random access to the lines of a JSON-per-line file, using the sidecar
+    index written by build_line_index
+
+    Args:
+        path (str) The JSON-per-line file
+        index_path (str, optional) The index. Defaults to the path plus INDEX_SUFFIX
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self.offsets = array('Q')
+        with open(self.index_path, 'rb') as f:
+            self.offsets.fromfile(f, os.path.getsize(self.index_path) // self.offsets.itemsize)
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        if self.offsets[-1] != os.path.getsize(path):
+            raise ValueError('Index {} is out of date for {}'.format(self.index_path, path))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def record(self, i):
+        """Decode a single line
+
+        Args:
+            i (int) The line number, starting at 0
+
+        Returns: (dict) the JSON object on that line
+        """
+        if not 0 <= i < len(self):
+            raise IndexError('line {} out of range'.format(i))
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[i])
+            return serialization.loads(f.read(self.offsets[i + 1] - self.offsets[i]))
+
+    def iter_range(self, start, end):
+        """Stream the lines in [start, end), skipping malformed ones as
+        stream_json_file does
+
+        Args:
+            start (int) The first line number
+            end (int) The line number to stop before
+
+        Yields:
+            (dict) JSON objects
+        """
+        start = max(start, 0)
+        end = min(end, len(self))
+        if start >= end:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[start])
+            lines = BlockLineReader(
+                _BoundedReader(f, self.offsets[end] - self.offsets[start]),
+                log_interval=None
+            )
+            yield from _decode_lines(lines, start)
+
+    def shards(self, num_shards):
+        """Split the file into contiguous line ranges of roughly equal byte size
+
+        Args:
+            num_shards (int) How many ranges to produce
+
+        Returns: (list) of (start, end) line ranges, suitable for iter_range
+        """
+        total_bytes = self.offsets[-1]
+        boundaries = [0]
+        for shard in range(1, num_shards):
+            target = total_bytes * shard // num_shards
+            boundary = bisect_left(self.offsets, target, boundaries[-1], len(self))
+            boundaries.append(boundary)
+        boundaries.append(len(self))
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def iter_shard(self, shard, num_shards):
+        """Stream one of num_shards byte-balanced shards of the file
+
+        Args:
+            shard (int) Which shard to read, starting at 0
+            num_shards (int) The total number of shards
+
+        Yields:
+            (dict) JSON objects
+        """
+        return self.iter_range(*self.shards(num_shards)[shard])
+
+
+class ShardedJsonLinesWriter(object):
+    """Writes JSON objects to compressed JSON-per-line shards of bounded size,
+    plus a manifest listing each shard and its record count
+
+    Full shards are compressed, written, and optionally uploaded in a thread
+    pool while later shards are being filled.
+
+        upload_shard = partial(s3.upload, s3_conn, s3_path='bucket/postings/2015Q1')
+        with ShardedJsonLinesWriter('tmp/2015Q1', upload=upload_shard) as writer:
+            for posting in importer.postings('2015Q1'):
+                writer.write(posting)
+
+    Args:
+        directory (str) The local directory to write shards to
+        prefix (str) The beginning of each shard's filename
+        max_bytes (int) The largest uncompressed size of a shard. A single
+            line larger than this gets a shard of its own
+        compression (str, optional) 'gzip', 'bz2', or None
+        compresslevel (int) The compression level
+        workers (int) How many shards may be compressed and written at once
+        upload (function, optional) Called with the local path of each shard
+            once it is written, and of the manifest once the writer is closed
+    """
+    def __init__(self, directory, prefix='part', max_bytes=128 * 1024 * 1024,
+                 compression='gzip', compresslevel=6, workers=4, upload=None):
+        if compression not in COMPRESSORS:
+            raise ValueError('Unknown compression {}'.format(compression))
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.workers = workers
+        self.upload = upload
+        os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        self.shards = []
+        self.lines = []
+        self.shard_bytes = 0
+        self.total_records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
+
+    def write(self, data):
+        """Add a JSON-serializable object to the current shard"""
+        line = serialization.dumps_bytes(data) + b'\n'
+        if self.lines and self.shard_bytes + len(line) > self.max_bytes:
+            self._finish_shard()
+        self.lines.append(line)
+        self.shard_bytes += len(line)
+        self.total_records += 1
+
+    def _finish_shard(self):
+        if not self.lines:
+            return
+        extension, _ = COMPRESSORS[self.compression]
+        filename = '{}-{:05d}.json{}'.format(self.prefix, len(self.shards), extension)
+        self.shards.append(None)
+        self.pending.append(self.executor.submit(
+            self._write_shard,
+            len(self.shards) - 1,
+            filename,
+            self.lines
+        ))
+        self.lines = []
+        self.shard_bytes = 0
+        while len(self.pending) > self.workers:
+            self.pending.popleft().result()
+
+    def _write_shard(self, shard_number, filename, lines):
+        """Compress, write and upload a shard. Runs in the thread pool"""
+        data = b''.join(lines)
+        _, compress = COMPRESSORS[self.compression]
+        compressed = compress(data, self.compresslevel)
+        path = os.path.join(self.directory, filename)
+        with open(path, 'wb') as f:
+            f.write(compressed)
+        if self.upload:
+            self.upload(path)
+        logging.info('Wrote shard %s with %d records', path, len(lines))
+        self.shards[shard_number] = {
+            'filename': filename,
+            'records': len(lines),
+            'bytes': len(data),
+            'compressed_bytes': len(compressed),
+        }
+
+    def close(self):
+        """Write the final shard and the manifest, and wait for all uploads
+
+        Returns: (dict) the manifest
+        """
+        self._finish_shard()
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown(wait=True)
+        manifest = {
+            'compression': self.compression,
+            'total_records': self.total_records,
+            'shards': self.shards,
+        }
+        path = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(path, 'wb') as f:
+            f.write(serialization.dumps_bytes(manifest))
+        if self.upload:
+            self.upload(path)
+        return manifest
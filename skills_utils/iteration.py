@@ -1,4 +1,16 @@
 """Iteration utilities"""
+from collections import deque
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
+import inspect
+import threading
+import time
+
+from skills_utils import serialization
+
+_ASYNC_END = object()
+
 
 class Batch:
     """Yields batches (groups) from an iterable
@@ -41,3 +53,388 @@ class Batch:
 
         while self.on_going:
             yield self.group()
+
+
+def estimate_size(item):
+    """Estimate the size of an item in bytes, as it would be sent over the wire
+
+    Strings and bytes are measured directly; anything else is measured
+    by its JSON serialization.
+    """
+    if isinstance(item, (bytes, str)):
+        return len(item)
+    return len(serialization.dumps_bytes(item))
+
+
+class MaterializedBatch:
+    """Yields batches from an iterable as lists, which unlike Batch's groups
+    remain valid after the next batch is requested
+
+    A batch is closed as soon as any of the configured bounds is reached.
+
+    Args:
+        iterable (iterable) any iterable
+        limit (int, optional) How many items to include per batch
+        max_bytes (int, optional) The largest estimated size, in bytes, of a batch.
+            An item larger than this on its own is yielded as a batch of one
+        max_wait (float, optional) How many seconds after its first item
+            arrives to yield a batch, even if it is not full. Useful for slow
+            sources. The iterable is consumed in a background thread
+        size_function (function) Estimates the size of an item, in bytes
+    """
+    def __init__(self, iterable, limit=None, max_bytes=None, max_wait=None,
+                 size_function=estimate_size):
+        self.iterable = iterable
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.size_function = size_function
+
+    def __iter__(self):
+        if self.max_wait is not None:
+            return self._timed_batches()
+        if self.max_bytes is None:
+            return self._counted_batches()
+        return self._sized_batches()
+
+    def _counted_batches(self):
+        iterator = iter(self.iterable)
+        while True:
+            batch = list(islice(iterator, self.limit))
+            if not batch:
+                return
+            yield batch
+
+    def _sized_batches(self):
+        batch = []
+        batch_size = 0
+        for item in self.iterable:
+            item_size = self.size_function(item)
+            if batch and batch_size + item_size > self.max_bytes:
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(item)
+            batch_size += item_size
+            if self.limit and len(batch) >= self.limit:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+
+    def _timed_batches(self):
+        collector = _TimedBatchCollector(self)
+        thread = threading.Thread(
+            target=collector.fill,
+            args=(self.iterable,),
+            name='MaterializedBatch-fill',
+            daemon=True
+        )
+        thread.start()
+        return collector.batches()
+
+
+class _TimedBatchCollector:
+    """Shared state for MaterializedBatch's max_wait mode
+
+    A background thread adds items to the open batch, closing it when it is
+    full; the consuming thread closes it early once its deadline passes.
+    """
+    MAX_READY_BATCHES = 2
+
+    def __init__(self, batcher):
+        self.limit = batcher.limit
+        self.max_bytes = batcher.max_bytes
+        self.max_wait = batcher.max_wait
+        self.size_function = batcher.size_function
+        self.condition = threading.Condition(threading.Lock())
+        self.ready = deque()
+        self.batch = []
+        self.batch_size = 0
+        self.deadline = None
+        self.done = False
+        self.stopped = False
+        self.error = None
+
+    def _close_batch(self):
+        self.ready.append(self.batch)
+        self.batch = []
+        self.batch_size = 0
+        self.condition.notify_all()
+
+    def fill(self, iterable):
+        """Add every item in the iterable to batches. Runs in a background thread"""
+        try:
+            for item in iterable:
+                item_size = self.size_function(item) if self.max_bytes is not None else 0
+                with self.condition:
+                    while len(self.ready) >= self.MAX_READY_BATCHES and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    if self.batch and self.max_bytes is not None \
+                            and self.batch_size + item_size > self.max_bytes:
+                        self._close_batch()
+                    if not self.batch:
+                        self.deadline = time.monotonic() + self.max_wait
+                        # wake the consumer so it starts timing the new batch
+                        self.condition.notify_all()
+                    self.batch.append(item)
+                    self.batch_size += item_size
+                    if self.limit and len(self.batch) >= self.limit:
+                        self._close_batch()
+        except Exception as e:
+            self.error = e
+        with self.condition:
+            if self.batch:
+                self._close_batch()
+            self.done = True
+            self.condition.notify_all()
+
+    def batches(self):
+        """Yield batches as they are closed, closing any that are overdue"""
+        try:
+            while True:
+                with self.condition:
+                    while not self.ready and not self.done:
+                        if not self.batch:
+                            self.condition.wait()
+                            continue
+                        timeout = self.deadline - time.monotonic()
+                        if timeout <= 0:
+                            self._close_batch()
+                        else:
+                            self.condition.wait(timeout)
+                    if self.ready:
+                        batch = self.ready.popleft()
+                        self.condition.notify_all()
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                yield batch
+        finally:
+            # let the filling thread exit if the consumer stops early
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+
+
+class BatchProcessingError(Exception):
+    """Raised by parallel_batch_map when the function fails on a batch
+
+    Attributes:
+        batch_index (int) The position of the failed batch, starting at 0
+        error (Exception) The exception raised by the function
+    """
+    def __init__(self, batch_index, error):
+        super().__init__('Batch {} failed: {!r}'.format(batch_index, error))
+        self.batch_index = batch_index
+        self.error = error
+
+
+def parallel_batch_map(function, iterable, limit, workers=4, use_processes=False,
+                       max_in_flight=None, ordered=True, **batch_kwargs):
+    """Apply a function to batches of an iterable in a thread or process pool
+
+    Only a bounded number of batches are read ahead of the results being
+    consumed, so memory use stays flat even for endless iterables.
+
+        for result in parallel_batch_map(process, iterable, 100):
+            do_stuff(result)
+
+    Args:
+        function (function) Called with each batch, as a list. Must be
+            picklable if use_processes is set
+        iterable (iterable) any iterable
+        limit (int) How many items to include per batch
+        workers (int) The size of the pool
+        use_processes (bool) Whether to use a process pool instead of a thread pool
+        max_in_flight (int, optional) How many batches may be submitted but not yet
+            consumed. Defaults to twice the number of workers
+        ordered (bool) Whether to yield results in batch order. If False, results
+            are yielded as soon as they are ready
+        **batch_kwargs: Other bounds (max_bytes, max_wait) passed to MaterializedBatch
+
+    Yields:
+        The result of the function for each batch
+
+    Raises:
+        BatchProcessingError if the function raises for any batch
+    """
+    max_in_flight = max_in_flight or 2 * workers
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    pending = deque()
+    with executor_class(workers) as executor:
+        try:
+            batches = MaterializedBatch(iterable, limit, **batch_kwargs)
+            for batch_index, batch in enumerate(batches):
+                future = executor.submit(function, batch)
+                future.batch_index = batch_index
+                pending.append(future)
+                if len(pending) >= max_in_flight:
+                    yield from _collect_batch_results(pending, ordered)
+            while pending:
+                yield from _collect_batch_results(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _collect_batch_results(pending, ordered):
+    """Remove the next finished future(s) from pending and return their results"""
+    if ordered:
+        finished = [pending.popleft()]
+    else:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        finished = [future for future in pending if future in done]
+        for future in finished:
+            pending.remove(future)
+    results = []
+    for future in finished:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            raise BatchProcessingError(future.batch_index, e) from e
+    return results
+
+
+async def aiterate(iterable, chunk_size=100):
+    """Iterate over a synchronous or asynchronous iterable from a coroutine
+
+    Synchronous iterables are advanced in the default executor, chunk_size
+    items at a time, so that blocking sources do not stall the event loop.
+
+        async for item in aiterate(iterable):
+            do_stuff(item)
+
+    Args:
+        iterable (iterable|async iterable) any iterable
+        chunk_size (int) How many items of a synchronous iterable to fetch
+            per trip to the executor
+    """
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+        return
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    while True:
+        chunk = await loop.run_in_executor(None, list, islice(iterator, chunk_size))
+        if not chunk:
+            return
+        for item in chunk:
+            yield item
+
+
+class AsyncBatch:
+    """Yields batches, as lists, from a synchronous or asynchronous iterable
+    without blocking the event loop
+
+        async for batch in AsyncBatch(iterable, 10):
+            await do_stuff(batch)
+
+    Args:
+        iterable (iterable|async iterable) any iterable
+        limit (int) How many items to include per batch
+        max_wait (float, optional) How many seconds after its first item
+            arrives to yield a batch, even if it is not full
+    """
+    def __init__(self, iterable, limit=None, max_wait=None):
+        self.iterable = iterable
+        self.limit = limit
+        self.max_wait = max_wait
+
+    def __aiter__(self):
+        if self.max_wait is None:
+            return self._batches()
+        return self._timed_batches()
+
+    async def _batches(self):
+        batch = []
+        async for item in aiterate(self.iterable):
+            batch.append(item)
+            if self.limit and len(batch) >= self.limit:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def _timed_batches(self):
+        items = asyncio.Queue(maxsize=self.limit or 1024)
+        producer = asyncio.ensure_future(_fill_async_queue(self.iterable, items))
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = deadline - time.monotonic() if batch else None
+                try:
+                    item = await asyncio.wait_for(items.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield batch
+                    batch = []
+                    continue
+                if item is _ASYNC_END:
+                    break
+                if isinstance(item, _AsyncFailure):
+                    raise item.error
+                if not batch:
+                    deadline = time.monotonic() + self.max_wait
+                batch.append(item)
+                if self.limit and len(batch) >= self.limit:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            producer.cancel()
+
+
+class _AsyncFailure:
+    """Carries an exception from _fill_async_queue to the queue's consumer"""
+    def __init__(self, error):
+        self.error = error
+
+
+async def _fill_async_queue(iterable, items):
+    """Copy a synchronous or asynchronous iterable onto an asyncio queue,
+    followed by _ASYNC_END, or by an _AsyncFailure if iteration fails"""
+    try:
+        async for item in aiterate(iterable):
+            await items.put(item)
+    except Exception as e:
+        await items.put(_AsyncFailure(e))
+    else:
+        await items.put(_ASYNC_END)
+
+
+async def aprefetch(iterable, size=100):
+    """Iterate over a synchronous or asynchronous iterable, reading up to
+    size items ahead in a separate task so that fetching overlaps with
+    whatever the consumer does between items
+
+    Args:
+        iterable (iterable|async iterable) any iterable
+        size (int) How many items to read ahead
+    """
+    items = asyncio.Queue(maxsize=size)
+    producer = asyncio.ensure_future(_fill_async_queue(iterable, items))
+    try:
+        while True:
+            item = await items.get()
+            if item is _ASYNC_END:
+                return
+            if isinstance(item, _AsyncFailure):
+                raise item.error
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def maybe_await(value):
+    """Await the value if it is awaitable, otherwise return it as-is.
+    Lets async code call hooks that may be implemented either way"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
@@ -1,5 +1,42 @@
 """Common Schema Job Posting utilities"""
+from itertools import chain, islice, repeat
+import json
 import logging
+import multiprocessing
+import pickle
+import queue
+import time
+
+from skills_utils import serialization
+from skills_utils.fs import read_bytes, write_bytes
+from skills_utils.iteration import (
+    AsyncBatch,
+    MaterializedBatch,
+    aprefetch,
+    maybe_await,
+)
+
+_END = object()
+
+MANDATORY_FIELDS = [
+    'title',
+    'description',
+    'datePosted',
+    'validThrough',
+    'jobLocation',
+]
+
+
+def _check_batch_length(documents, transformed):
+    """Returns: (list) the output of _transform_batch for the given documents,
+    raising a ValueError unless there is one transformed document for each"""
+    transformed = list(transformed)
+    if len(transformed) != len(documents):
+        raise ValueError('_transform_batch returned {} documents for a batch of {}'.format(
+            len(transformed),
+            len(documents)
+        ))
+    return transformed
 
 
 class JobPostingImportBase(object):
@@ -7,6 +44,16 @@ class JobPostingImportBase(object):
     some source into a common schema. (http://schema.org/JobPosting)
 
     Subclasses must implement _id, _iter_postings, and _transform.
+    For use with apostings, any of these may instead be implemented as
+    coroutines (or, for _iter_postings, an async generator).
+    Subclasses whose quarters divide naturally (into files, S3 keys, etc)
+    may instead implement _partitions and _iter_partition_postings,
+    which enables the parallel mode of postings.
+    Subclasses that can transform many documents more cheaply than one at a
+    time (e.g. by looking up repeated values once) may also implement
+    _transform_batch(documents), returning a list of transformed documents
+    in the same order. It is then used instead of _transform, with batches
+    of TRANSFORM_BATCH_SIZE documents.
 
     Args:
         partner_id (str) An short identifier for the partner (ie NLX, VA)
@@ -18,21 +65,353 @@ class JobPostingImportBase(object):
         self.s3_conn = s3_conn
         self.onet_cache = onet_cache
 
-    def postings(self, quarter, stats_counter=None):
+    TRANSFORM_BATCH_SIZE = 100
+    # How many batches of transformed postings each worker process may send
+    # ahead of the consumer in the parallel mode of postings
+    PARALLEL_BATCHES_AHEAD = 4
+    STAGE_TIMING_SAMPLE = 16
+
+    def postings(self, quarter, stats_counter=None, processes=None, checkpoint=None,
+                 dedupe=None):
         """Yield job postings in common schema format
 
         Args:
             quarter (str) The quarter, in format '2015Q1'
             stats_counter (object, optional) A counter that can track both
-                input and output documents using a 'track' method.
+                input and output documents using a 'track' method, such as
+                ImportStats. If it also has track_skipped, track_error or
+                add_stage_time methods, those are called for duplicate postings,
+                transform errors and time spent in each stage
+            processes (int, optional) If given, transform the quarter's partitions
+                in a pool of this many worker processes. Postings are yielded in
+                the same order and with the same ids as a serial run.
+                Requires _partitions and _iter_partition_postings, and that the
+                importer be picklable
+            checkpoint (ImportCheckpoint, optional) Records which postings have
+                been consumed, and on a later run skips them without transforming
+                them again. Skipping whole partitions without reading them
+                requires _partitions and _iter_partition_postings
+            dedupe (dedupe.HashSet|dedupe.BloomFilter, optional) Ids that have
+                already been imported. Postings whose id is present are skipped
+                (before transformation, except in parallel mode), and new ids
+                are added once their posting has been consumed, like checkpoint
+                progress. Save it after the import to carry it to the next run
         """
         logging.info('Finding postings for %s', quarter)
-        for posting in self._iter_postings(quarter):
-            transformed = self._transform(posting)
+        if checkpoint is not None:
+            checkpoint.load(quarter)
+            if checkpoint.done:
+                logging.info('Checkpoint shows %s is already complete', quarter)
+                return
+        if processes:
+            partitions = self._parallel_postings(quarter, stats_counter, processes, checkpoint)
+        else:
+            partitions = self._serial_postings(quarter, checkpoint, dedupe, stats_counter)
+        track_skipped = getattr(stats_counter, 'track_skipped', None)
+        for partition, postings in partitions:
+            for posting, transformed in postings:
+                if processes and dedupe is not None and transformed['id'] in dedupe:
+                    transformed = None
+                if transformed is None:
+                    if track_skipped:
+                        track_skipped(input_document=posting)
+                    if checkpoint is not None:
+                        checkpoint.record(partition)
+                    continue
+                if stats_counter:
+                    stats_counter.track(
+                        input_document=posting,
+                        output_document=transformed
+                    )
+                yield transformed
+                if processes and dedupe is not None:
+                    dedupe.add(transformed['id'])
+                if checkpoint is not None:
+                    checkpoint.record(partition)
+            if checkpoint is not None and partition is not None:
+                checkpoint.complete_partition(partition)
+        if checkpoint is not None:
+            checkpoint.finish()
+
+    def _serial_postings(self, quarter, checkpoint, dedupe=None, stats_counter=None):
+        """Transform a quarter's postings in this process
+
+        Yields: (tuple) a partition (None for unpartitioned importers) and an
+            iterable of (raw posting, transformed posting) tuples from that
+            partition. Transformed postings are None for duplicates
+        """
+        partitions = self._partitions(quarter) if checkpoint is not None else None
+        if partitions is None:
+            raw_postings = self._iter_postings(quarter)
+            if hasattr(raw_postings, '__aiter__'):
+                raise TypeError('_iter_postings is asynchronous, use apostings instead')
+            if checkpoint is not None:
+                raw_postings = islice(raw_postings, checkpoint.offset(None), None)
+            yield None, self._transform_postings(raw_postings, dedupe, stats_counter)
+            return
+        for partition in partitions:
+            if checkpoint.is_complete(partition):
+                continue
+            raw_postings = islice(
+                self._iter_partition_postings(partition),
+                checkpoint.offset(partition),
+                None
+            )
+            yield partition, self._transform_postings(raw_postings, dedupe, stats_counter)
+
+    def _transform_postings(self, raw_postings, dedupe=None, stats_counter=None):
+        """Transform raw postings into common schema postings with partner ids
+
+        Args:
+            raw_postings (iterable) job posting documents in their original format
+            dedupe (dedupe.HashSet|dedupe.BloomFilter, optional) Previously seen ids
+            stats_counter (object, optional) Receives stage timings and
+                transform errors, if it has add_stage_time and track_error methods
+
+        Yields: (tuple) each raw posting and its transformed version,
+            or None in place of the transformed version for duplicates
+        """
+        add_stage_time = getattr(stats_counter, 'add_stage_time', None)
+        track_error = getattr(stats_counter, 'track_error', None)
+        if hasattr(self, '_transform_batch'):
+            return self._transform_posting_batches(
+                raw_postings,
+                dedupe,
+                track_error,
+                add_stage_time
+            )
+        if add_stage_time:
+            return self._timed_transform_postings(
+                raw_postings,
+                dedupe,
+                track_error,
+                add_stage_time
+            )
+        return self._untimed_transform_postings(raw_postings, dedupe, track_error)
+
+    def _untimed_transform_postings(self, raw_postings, dedupe, track_error):
+        for posting in raw_postings:
+            posting_id = self._posting_id(posting)
+            if dedupe is not None and posting_id in dedupe:
+                yield posting, None
+                continue
+            try:
+                transformed = self._transform(posting)
+            except Exception as e:
+                if track_error:
+                    track_error(input_document=posting, error=e)
+                raise
+            transformed['id'] = posting_id
+            yield posting, transformed
+            # only once the posting has been consumed
+            if dedupe is not None:
+                dedupe.add(posting_id)
+
+    def _timed_transform_postings(self, raw_postings, dedupe, track_error, add_stage_time):
+        """_untimed_transform_postings, additionally timing one in every
+        STAGE_TIMING_SAMPLE postings to estimate the time spent reading and
+        transforming postings, which is reported at the end"""
+        clock = time.perf_counter
+        iterator = iter(raw_postings)
+        untimed_per_sample = self.STAGE_TIMING_SAMPLE - 1
+        iter_seconds = 0.0
+        transform_seconds = 0.0
+        timed = 0
+        total = 0
+        try:
+            while True:
+                start = clock()
+                posting = next(iterator, _END)
+                fetched = clock()
+                if posting is _END:
+                    return
+                iter_seconds += fetched - start
+                timed += 1
+                total += 1
+                posting_id = self._posting_id(posting)
+                if dedupe is not None and posting_id in dedupe:
+                    transform_seconds += clock() - fetched
+                    yield posting, None
+                else:
+                    try:
+                        transformed = self._transform(posting)
+                    except Exception as e:
+                        if track_error:
+                            track_error(input_document=posting, error=e)
+                        raise
+                    transformed['id'] = posting_id
+                    transform_seconds += clock() - fetched
+                    yield posting, transformed
+                    if dedupe is not None:
+                        dedupe.add(posting_id)
+                for result in self._untimed_transform_postings(
+                    islice(iterator, untimed_per_sample),
+                    dedupe,
+                    track_error
+                ):
+                    total += 1
+                    yield result
+        finally:
+            if timed:
+                add_stage_time('iter_postings', iter_seconds * total / timed)
+                add_stage_time('transform', transform_seconds * total / timed)
+
+    def _transform_posting_batches(self, raw_postings, dedupe, track_error, add_stage_time):
+        """Transform postings TRANSFORM_BATCH_SIZE at a time using _transform_batch"""
+        clock = time.perf_counter
+        batches = iter(MaterializedBatch(raw_postings, self.TRANSFORM_BATCH_SIZE))
+        while True:
+            start = clock()
+            batch = next(batches, _END)
+            fetched = clock()
+            if batch is _END:
+                break
+            ids = [self._posting_id(posting) for posting in batch]
+            if dedupe is None:
+                new = [True] * len(batch)
+            else:
+                # ids are only added to dedupe as their postings are consumed,
+                # so repeats within the batch are found here
+                batch_ids = set()
+                new = []
+                for posting_id in ids:
+                    new.append(posting_id not in dedupe and posting_id not in batch_ids)
+                    batch_ids.add(posting_id)
+            new_postings = [posting for posting, is_new in zip(batch, new) if is_new]
+            try:
+                transformed_batch = iter(_check_batch_length(
+                    new_postings,
+                    self._transform_batch(new_postings) if new_postings else []
+                ))
+            except Exception as e:
+                if track_error:
+                    # the batch failed as a whole, so each of its postings did
+                    for posting in new_postings:
+                        track_error(input_document=posting, error=e)
+                raise
+            if add_stage_time:
+                add_stage_time('iter_postings', fetched - start)
+                add_stage_time('transform', clock() - fetched)
+            for posting, posting_id, is_new in zip(batch, ids, new):
+                if not is_new:
+                    yield posting, None
+                    continue
+                transformed = next(transformed_batch)
+                transformed['id'] = posting_id
+                yield posting, transformed
+                if dedupe is not None:
+                    dedupe.add(posting_id)
+
+    def _posting_id(self, document):
+        """The partner-prefixed id of a raw job posting document"""
+        return '{}_{}'.format(self.partner_id, self._id(document))
+
+    async def _atransform_postings(self, raw_postings):
+        """Asynchronous version of _transform_postings, for apostings"""
+        if hasattr(self, '_transform_batch'):
+            async for batch in AsyncBatch(raw_postings, self.TRANSFORM_BATCH_SIZE):
+                transformed_batch = _check_batch_length(
+                    batch,
+                    await maybe_await(self._transform_batch(batch))
+                )
+                for posting, transformed in zip(batch, transformed_batch):
+                    transformed['id'] = '{}_{}'.format(
+                        self.partner_id,
+                        await maybe_await(self._id(posting))
+                    )
+                    yield posting, transformed
+            return
+        async for posting in raw_postings:
+            transformed = await maybe_await(self._transform(posting))
             transformed['id'] = '{}_{}'.format(
                 self.partner_id,
-                self._id(posting)
+                await maybe_await(self._id(posting))
             )
+            yield posting, transformed
+
+    def _parallel_postings(self, quarter, stats_counter, processes, checkpoint):
+        """Transform a quarter's postings in worker processes
+
+        Partitions are dealt out to the workers in turn. Each worker sends its
+        postings back TRANSFORM_BATCH_SIZE at a time through its own queue of
+        at most PARALLEL_BATCHES_AHEAD batches, so memory use does not grow
+        with the size of the partitions.
+
+        Raw postings are only sent back to this process if a stats_counter needs
+        them. ImportStats counters instead get stage timings and errors merged
+        in from a fresh counter in each worker.
+
+        Yields: (tuple) a partition and an iterable of (raw posting, transformed
+            posting) tuples from that partition. Raw postings may be None
+        """
+        partitions = self._partitions(quarter)
+        if partitions is None:
+            raise NotImplementedError(
+                'Parallel postings require _partitions and _iter_partition_postings'
+            )
+        if checkpoint is not None:
+            partitions = [
+                partition for partition in partitions
+                if not checkpoint.is_complete(partition)
+            ]
+        offsets = [
+            checkpoint.offset(partition) if checkpoint is not None else 0
+            for partition in partitions
+        ]
+        mergeable = isinstance(stats_counter, ImportStats)
+        num_workers = min(processes, len(partitions))
+        queues = [multiprocessing.Queue(self.PARALLEL_BATCHES_AHEAD) for _ in range(num_workers)]
+        workers = [
+            multiprocessing.Process(
+                target=_transform_partitions,
+                args=(
+                    self,
+                    stats_counter is not None and not mergeable,
+                    stats_counter.empty_copy() if mergeable else None,
+                    list(zip(partitions, offsets))[worker::num_workers],
+                    queues[worker],
+                ),
+                daemon=True
+            )
+            for worker in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for i, partition in enumerate(partitions):
+                yield partition, _received_postings(
+                    queues[i % num_workers],
+                    workers[i % num_workers],
+                    stats_counter if mergeable else None
+                )
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+
+    async def apostings(self, quarter, stats_counter=None, prefetch=100):
+        """Asynchronously yield job postings in common schema format
+
+        Raw postings are fetched in a separate task, up to prefetch documents
+        ahead, so that network-bound sources overlap with transformation and
+        with the consumer. Synchronous _iter_postings implementations are run
+        in the default executor.
+
+            async for posting in importer.apostings('2015Q1'):
+                do_stuff(posting)
+
+        Args:
+            quarter (str) The quarter, in format '2015Q1'
+            stats_counter (object, optional) A counter that can track both
+                input and output documents using a 'track' method.
+            prefetch (int) How many raw postings to read ahead
+        """
+        logging.info('Finding postings for %s', quarter)
+        raw_postings = aprefetch(self._iter_postings(quarter), prefetch)
+        async for posting, transformed in self._atransform_postings(raw_postings):
             if stats_counter:
                 stats_counter.track(
                     input_document=posting,
@@ -53,11 +432,41 @@ class JobPostingImportBase(object):
 
     def _iter_postings(self, quarter):
         """Given a quarter, yield all relevant raw job posting documents.
-        To be implemented by subclasses
+        To be implemented by subclasses, unless they implement _partitions and
+        _iter_partition_postings, in which case each partition is read in turn
 
         Args:
             quarter (str) The quarter, in format '2015Q1'
 
+        Yields: job posting documents in their original format
+        """
+        partitions = self._partitions(quarter)
+        if partitions is None:
+            return None
+        return chain.from_iterable(
+            self._iter_partition_postings(partition)
+            for partition in partitions
+        )
+
+    def _partitions(self, quarter):
+        """Given a quarter, list independently readable parts of its raw job
+        postings, such as files or S3 keys. Optionally implemented by subclasses
+
+        Args:
+            quarter (str) The quarter, in format '2015Q1'
+
+        Returns: (list) picklable partition descriptors, in a stable order,
+            or None if the importer is not partitioned
+        """
+        return None
+
+    def _iter_partition_postings(self, partition):
+        """Given a partition, yield its raw job posting documents.
+        To be implemented by subclasses that implement _partitions
+
+        Args:
+            partition - One of the values returned by _partitions
+
         Yields: job posting documents in their original format
         """
         pass
@@ -73,3 +482,262 @@ class JobPostingImportBase(object):
         Returns: (dict) The job posting, in common schema form
         """
         pass
+
+
+def _transform_partitions(importer, keep_raw_postings, worker_stats, partitions, results):
+    """Transform the postings in a list of partitions. Runs in a worker process
+
+    For each partition, puts ('batch', raw postings, transformed postings)
+    tuples of up to TRANSFORM_BATCH_SIZE postings on the results queue,
+    then ('done', worker_stats). If a posting fails, puts ('error', exception)
+    and stops.
+
+    Args:
+        importer (JobPostingImportBase) the importer
+        keep_raw_postings (bool) Whether to send the raw postings as well
+        worker_stats (ImportStats, optional) Records stage timings and errors,
+            starting afresh for each partition
+        partitions (list) tuples of a partition descriptor from
+            importer._partitions and how many of its postings to skip
+        results (multiprocessing.Queue) where to put the results
+    """
+    try:
+        for partition, offset in partitions:
+            raw = islice(importer._iter_partition_postings(partition), offset, None)
+            transformed_postings = importer._transform_postings(raw, stats_counter=worker_stats)
+            for batch in MaterializedBatch(transformed_postings, importer.TRANSFORM_BATCH_SIZE):
+                results.put((
+                    'batch',
+                    [posting for posting, _ in batch] if keep_raw_postings else None,
+                    [transformed for _, transformed in batch],
+                ))
+            results.put(('done', worker_stats))
+            if worker_stats is not None:
+                worker_stats = worker_stats.empty_copy()
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(repr(e))
+        results.put(('error', e))
+
+
+def _received_postings(results, worker, stats_counter):
+    """Yield one partition's (raw posting, transformed posting) tuples
+    from a worker's results queue, merging its stats into stats_counter"""
+    while True:
+        try:
+            message = results.get(timeout=1)
+        except queue.Empty:
+            if worker.is_alive():
+                continue
+            try:
+                # anything sent before the worker exited is still readable
+                message = results.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError(
+                    'Import worker exited with code {}'.format(worker.exitcode)
+                ) from None
+        kind = message[0]
+        if kind == 'error':
+            raise message[1]
+        if kind == 'done':
+            if stats_counter is not None:
+                stats_counter.merge(message[1])
+            return
+        _, raw_postings, transformed_postings = message
+        yield from zip(raw_postings or repeat(None), transformed_postings)
+
+
+class ImportCheckpoint(object):
+    """Records how far JobPostingImportBase.postings has got through a quarter,
+    so that an interrupted import can resume where it left off
+
+    Progress is tracked as a set of completed partitions, plus how many
+    postings of the current partition have been consumed. A posting counts
+    as consumed once the caller asks for the next one.
+
+    Args:
+        path (str) A local filename, or an s3://bucket/key path,
+            to store the checkpoint as JSON
+        save_every (int) How many consumed postings between saves
+    """
+    def __init__(self, path, save_every=10000):
+        self.path = path
+        self.save_every = save_every
+        self.quarter = None
+        self.reset()
+
+    def reset(self):
+        self.completed_partitions = set()
+        self.partition = None
+        self.partition_offset = 0
+        self.unsaved = 0
+        self.done = False
+
+    @staticmethod
+    def _key(partition):
+        # canonical JSON, so a partition given as a dict matches its saved
+        # key whatever the order of its keys
+        return json.dumps(partition, sort_keys=True, separators=(',', ':'))
+
+    def load(self, quarter):
+        """Load saved progress for the given quarter, if there is any"""
+        self.quarter = quarter
+        self.reset()
+        saved = read_bytes(self.path)
+        if not saved:
+            return
+        state = serialization.loads(saved)
+        if state['quarter'] != quarter:
+            logging.info('Ignoring checkpoint for a different quarter, %s', state['quarter'])
+            return
+        self.completed_partitions = set(state['completed_partitions'])
+        self.partition = state['partition']
+        self.partition_offset = state['partition_offset']
+        self.done = state['done']
+        logging.info(
+            'Resuming %s after %d complete partitions and %d postings of the current one',
+            quarter,
+            len(self.completed_partitions),
+            self.partition_offset
+        )
+
+    def save(self):
+        write_bytes(self.path, serialization.dumps_bytes({
+            'quarter': self.quarter,
+            'completed_partitions': sorted(self.completed_partitions),
+            'partition': self.partition,
+            'partition_offset': self.partition_offset,
+            'done': self.done,
+        }))
+        self.unsaved = 0
+
+    def is_complete(self, partition):
+        return self._key(partition) in self.completed_partitions
+
+    def offset(self, partition):
+        """Returns: (int) how many postings of the partition have been consumed"""
+        if self._key(partition) == self.partition:
+            return self.partition_offset
+        return 0
+
+    def record(self, partition):
+        """Record that one more posting of the partition has been consumed"""
+        key = self._key(partition)
+        if key != self.partition:
+            self.partition = key
+            self.partition_offset = 0
+        self.partition_offset += 1
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def complete_partition(self, partition):
+        """Record that every posting of the partition has been consumed"""
+        self.completed_partitions.add(self._key(partition))
+        self.partition = None
+        self.partition_offset = 0
+        self.save()
+
+    def finish(self):
+        """Record that the whole quarter has been consumed"""
+        self.done = True
+        self.save()
+
+
+class ImportStats(object):
+    """A low-overhead counter for JobPostingImportBase.postings
+
+    Tracks documents in and out, duplicates skipped, transform errors, how
+    often each common schema field is filled in, and the time spent reading
+    raw postings (iter_postings) versus transforming them (transform).
+
+    To keep overhead to a few percent of import throughput, field fill rates
+    are measured on a sample of output documents, and postings estimates
+    stage timings from a sample of documents
+    (JobPostingImportBase.STAGE_TIMING_SAMPLE). Document counts are exact.
+
+    Args:
+        fields (list) The output fields whose fill rates to track.
+            Defaults to MANDATORY_FIELDS
+        field_sample (int) Check fields on one in this many output documents.
+            Pass 1 to check every document
+    """
+    STAGES = ('iter_postings', 'transform')
+
+    def __init__(self, fields=None, field_sample=8):
+        self.fields = list(fields or MANDATORY_FIELDS)
+        self.field_sample = field_sample
+        self.input_documents = 0
+        self.output_documents = 0
+        self.field_sampled_documents = 0
+        self.skipped_documents = 0
+        self.errors = 0
+        self.field_counts = dict.fromkeys(self.fields, 0)
+        self.stage_seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.start_time = time.time()
+
+    def empty_copy(self):
+        """Returns: (ImportStats) a new counter that tracks the same fields"""
+        return type(self)(self.fields, self.field_sample)
+
+    def track(self, input_document, output_document):
+        self.input_documents += 1
+        self.output_documents += 1
+        if (self.output_documents - 1) % self.field_sample:
+            return
+        self.field_sampled_documents += 1
+        field_counts = self.field_counts
+        for field in self.fields:
+            if output_document.get(field):
+                field_counts[field] += 1
+
+    def track_skipped(self, input_document):
+        self.input_documents += 1
+        self.skipped_documents += 1
+
+    def track_error(self, input_document, error):
+        self.input_documents += 1
+        self.errors += 1
+
+    def add_stage_time(self, stage, seconds):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def merge(self, other):
+        """Add the counts and timings from another ImportStats to this one"""
+        self.input_documents += other.input_documents
+        self.output_documents += other.output_documents
+        self.field_sampled_documents += other.field_sampled_documents
+        self.skipped_documents += other.skipped_documents
+        self.errors += other.errors
+        for field, count in other.field_counts.items():
+            self.field_counts[field] = self.field_counts.get(field, 0) + count
+        for stage, seconds in other.stage_seconds.items():
+            self.add_stage_time(stage, seconds)
+
+    def summary(self):
+        """Returns: (dict) JSON-serializable totals, rates and timings"""
+        elapsed = time.time() - self.start_time
+        return {
+            'input_documents': self.input_documents,
+            'output_documents': self.output_documents,
+            'skipped_documents': self.skipped_documents,
+            'errors': self.errors,
+            'field_fill_rates': {
+                field: count / self.field_sampled_documents if self.field_sampled_documents else 0.0
+                for field, count in self.field_counts.items()
+            },
+            'stage_seconds': dict(self.stage_seconds),
+            'elapsed_seconds': elapsed,
+            'output_documents_per_second': self.output_documents / elapsed if elapsed else 0.0,
+        }
+
+    def log(self):
+        """Log the summary"""
+        logging.info('Import stats: %s', self.summary())
+
+    def save(self, path):
+        """Save the summary as JSON to a local file or s3://bucket/key path,
+        e.g. next to the quarter's output"""
+        write_bytes(path, serialization.dumps_bytes(self.summary()))
@@ -1,14 +1,41 @@
 """
 Common S3 utilities
 """
+import base64
 import boto
-import json
+import hashlib
+import io
 import logging
 import os
+import queue
+import threading
+import time
+from collections import namedtuple
 from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import s3fs
 
+from skills_utils import serialization
+from skills_utils.io import open_json_lines, stream_json_file
+
+# Files larger than this are transferred in parts of PART_SIZE bytes,
+# CONCURRENCY at a time
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+CONCURRENCY = 8
+# User metadata recording the part size of multipart uploads
+PART_SIZE_METADATA = 'part-size'
+# Seconds to wait before the first retry of a failed request, doubling each time
+RETRY_BACKOFF = 0.5
+# The most listed objects held while waiting to be consumed
+LISTING_BUFFER_SIZE = 10000
+_LISTING_DONE = object()
+# Objects are streamed in ranged GETs of this many bytes, with up to
+# READ_AHEAD_BLOCKS of them fetched ahead of the reader
+READ_AHEAD_BLOCK_SIZE = 8 * 1024 * 1024
+READ_AHEAD_BLOCKS = 4
+
 
 def split_s3_path(path):
     """
@@ -21,13 +48,30 @@ def split_s3_path(path):
     return path.split('/', 1)
 
 
-def upload(s3_conn, filepath, s3_path):
+def upload(
+    s3_conn,
+    filepath,
+    s3_path,
+    part_size=PART_SIZE,
+    concurrency=CONCURRENCY,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    cb=None
+):
     """Uploads the given file to s3
 
+    Files larger than multipart_threshold are sent as a multipart upload,
+    with up to concurrency parts in flight. S3 checks each part against its
+    MD5, and the finished object's ETag is checked against the parts.
+
     Args:
         s3_conn: (boto.s3.connection) an s3 connection
         filepath (str) the local filename
         s3_path (str) the destination path on s3
+        part_size (int) bytes per part; S3 requires at least 5MB
+        concurrency (int) how many parts to upload at once
+        multipart_threshold (int) the smallest file to upload in parts
+        cb (function, optional) called with the bytes transferred so far
+            and the total, like log_download_progress
     """
     bucket_name, prefix = split_s3_path(s3_path)
     bucket = s3_conn.get_bucket(bucket_name)
@@ -38,10 +82,115 @@ def upload(s3_conn, filepath, s3_path):
         name='{}/{}'.format(prefix, filename)
     )
     logging.info('uploading from %s to %s', filepath, key)
-    key.set_contents_from_filename(filepath)
+    if os.path.getsize(filepath) > multipart_threshold:
+        _multipart_upload(bucket, key.name, filepath, part_size, concurrency, cb)
+    else:
+        key.set_contents_from_filename(filepath, cb=cb)
+
+
+def _part_ranges(size, part_size):
+    """Returns: (list) the (offset, length) of each part of a file"""
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def _multipart_etag(part_digests):
+    """The ETag S3 gives an object uploaded in parts with the given MD5 digests"""
+    return '{}-{}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+class _TransferProgress(object):
+    """Adds up bytes transferred by concurrent parts, reporting the total
+    through a boto-style callback(num_bytes, obj_size)"""
+    def __init__(self, total, cb=None):
+        self.total = total
+        self.cb = cb
+        self.transferred = 0
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, num_bytes):
+        with self.lock:
+            self.transferred += num_bytes
+            if self.cb:
+                self.cb(self.transferred, self.total)
+
+    def log_throughput(self, description):
+        elapsed = time.time() - self.start
+        logging.info(
+            '%s: %s bytes in %.1fs (%.1f MB/s)',
+            description,
+            self.transferred,
+            elapsed,
+            self.transferred / elapsed / 1024 / 1024 if elapsed else 0
+        )
+
 
+def _multipart_upload(bucket, key_name, filepath, part_size, concurrency, cb):
+    size = os.path.getsize(filepath)
+    progress = _TransferProgress(size, cb)
+    # Record the part size, since the multipart ETag can only be checked
+    # by a download that splits the object the same way
+    multipart = bucket.initiate_multipart_upload(
+        key_name,
+        metadata={PART_SIZE_METADATA: str(part_size)}
+    )
 
-def upload_dict(s3_conn, s3_prefix, data_to_sync):
+    def upload_part(numbered_part):
+        part_number, (offset, length) = numbered_part
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        digest = hashlib.md5(data)
+        multipart.upload_part_from_file(
+            io.BytesIO(data),
+            part_number,
+            md5=(digest.hexdigest(), base64.b64encode(digest.digest()).decode('ascii')),
+            size=length
+        )
+        progress.add(length)
+        return digest.digest()
+
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            part_digests = list(executor.map(
+                upload_part,
+                enumerate(_part_ranges(size, part_size), 1)
+            ))
+        completed = multipart.complete_upload()
+    except Exception:
+        logging.error('cancelling multipart upload of %s', key_name)
+        multipart.cancel_upload()
+        raise
+    if completed.etag.strip('"') != _multipart_etag(part_digests):
+        raise ValueError('Checksum mismatch uploading {}'.format(key_name))
+    progress.log_throughput('uploaded {} in {} parts'.format(key_name, len(part_digests)))
+
+
+class UploadError(Exception):
+    """Raised by upload_dict when some values could not be uploaded
+
+    Attributes:
+        errors (dict) The exception raised for each key that failed
+        results (dict) The outcome for every key, as returned by upload_dict
+    """
+    def __init__(self, errors, results):
+        super().__init__('Failed to upload {} keys: {}'.format(
+            len(errors),
+            ', '.join(sorted(map(str, errors)))
+        ))
+        self.errors = errors
+        self.results = results
+
+
+def upload_dict(
+    s3_conn,
+    s3_prefix,
+    data_to_sync,
+    concurrency=1,
+    skip_unchanged=False,
+    retries=0,
+    raise_on_error=True
+):
     """Syncs a dictionary to an S3 bucket, serializing each value in the
     dictionary as a JSON file with the key as its name.
 
@@ -49,54 +198,401 @@ def upload_dict(s3_conn, s3_prefix, data_to_sync):
         s3_conn: (boto.s3.connection) an s3 connection
         s3_prefix: (str) the destination prefix
         data_to_sync: (dict)
+        concurrency (int) how many values to upload at once, sharing the
+            connection's pool
+        skip_unchanged (bool) whether to skip values whose JSON matches the
+            existing object's ETag, found with one listing of the prefix
+        retries (int) how many times to retry uploads that fail with
+            a throttling, server or connection error
+        raise_on_error (bool) whether to raise once all uploads have finished
+            if any of them failed. If False, failures are only reported in
+            the results
+
+    Returns: (dict) for each key, 'uploaded', 'unchanged', or 'failed'
+
+    Raises:
+        UploadError if raise_on_error is set and any value failed to upload
     """
     bucket_name, prefix = split_s3_path(s3_prefix)
     bucket = s3_conn.get_bucket(bucket_name)
-
-    for key, value in data_to_sync.items():
+    remote_etags = {}
+    if skip_unchanged:
+        remote_etags = {
+            s3_key.name: s3_key.etag.strip('"')
+            for s3_key in bucket.list(prefix=prefix + '/')
+        }
+    results = {}
+    errors = {}
+
+    def sync(key, value):
         full_name = '{}/{}.json'.format(prefix, key)
-        s3_key = boto.s3.key.Key(
-            bucket=bucket,
-            name=full_name
-        )
-        logging.info('uploading key %s', full_name)
-        s3_key.set_contents_from_string(json.dumps(value))
+        contents = serialization.dumps_bytes(value)
+        if remote_etags.get(full_name) == hashlib.md5(contents).hexdigest():
+            results[key] = 'unchanged'
+            return
+        for attempt in range(retries + 1):
+            try:
+                s3_key = boto.s3.key.Key(
+                    bucket=bucket,
+                    name=full_name
+                )
+                logging.info('uploading key %s', full_name)
+                s3_key.set_contents_from_string(contents)
+                results[key] = 'uploaded'
+                return
+            except (boto.exception.BotoServerError, OSError) as e:
+                if attempt == retries or not _is_transient_error(e):
+                    logging.error('failed to upload key %s: %s', full_name, e)
+                    results[key] = 'failed'
+                    errors[key] = e
+                    return
+                backoff = RETRY_BACKOFF * 2 ** attempt
+                logging.warning('retrying key %s in %ss after %s', full_name, backoff, e)
+                time.sleep(backoff)
+
+    # Only a window of uploads is submitted at a time, so values are not all
+    # serialized (or queued) up front
+    pending = set()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for key, value in data_to_sync.items():
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(sync, key, value))
+        for future in pending:
+            future.result()
+    logging.info(
+        'Synced %d keys to %s: %d uploaded, %d unchanged, %d failed',
+        len(results),
+        s3_prefix,
+        sum(1 for result in results.values() if result == 'uploaded'),
+        sum(1 for result in results.values() if result == 'unchanged'),
+        len(errors),
+    )
+    if errors and raise_on_error:
+        raise UploadError(errors, results)
+    return results
+
 
+def _is_transient_error(error):
+    """Whether a failed S3 request is worth retrying"""
+    if isinstance(error, boto.exception.BotoServerError):
+        return error.status == 429 or error.status >= 500
+    return True
 
-def download(s3_conn, out_filename, s3_path):
+
+def log_download_progress(num_bytes, obj_size):
+    """Callback that boto can use to log download or upload progress"""
+    logging.info('%s bytes transferred out of %s total', num_bytes, obj_size)
+
+
+def download(
+    s3_conn,
+    out_filename,
+    s3_path,
+    part_size=PART_SIZE,
+    concurrency=CONCURRENCY,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    cb=log_download_progress,
+    verify=True
+):
     """Downloads the given s3_path
 
+    Objects larger than multipart_threshold are fetched with parallel
+    ranged GETs, up to concurrency at a time.
+
     Args:
         s3_conn (boto.s3.connection) a boto s3 connection
         out_filename (str) local filename to save the file
         s3_path (str) the source path on s3
+        part_size (int) bytes per ranged GET
+        concurrency (int) how many ranges to download at once
+        multipart_threshold (int) the smallest object to download in ranges
+        cb (function, optional) called with the bytes transferred so far and the total
+        verify (bool) whether to check the downloaded file against the object's ETag.
+            Objects encrypted with KMS or customer keys, and multipart uploads
+            whose part size is not recorded by upload, are not checked
     """
     bucket_name, prefix = split_s3_path(s3_path)
     bucket = s3_conn.get_bucket(bucket_name)
-    key = boto.s3.key.Key(
-        bucket=bucket,
-        name=prefix
-    )
+    key = bucket.get_key(prefix)
+    if key is None:
+        raise boto.exception.S3ResponseError(404, 'Not Found', 'No such key {}'.format(s3_path))
     logging.info('loading from %s into %s', key, out_filename)
-    key.get_contents_to_filename(out_filename, cb=log_download_progress)
+    part_digests = None
+    if key.size > multipart_threshold:
+        part_digests = _ranged_download(bucket, key, out_filename, part_size, concurrency, cb)
+    else:
+        key.get_contents_to_filename(out_filename, cb=cb)
+    if verify:
+        _verify_download(key, out_filename, part_size, part_digests)
+
+
+def _ranged_download(bucket, key, out_filename, part_size, concurrency, cb):
+    """Returns: (list) the MD5 digest of each part"""
+    progress = _TransferProgress(key.size, cb)
+    with open(out_filename, 'wb') as f:
+        f.truncate(key.size)
+
+    def download_part(part):
+        offset, length = part
+        part_key = boto.s3.key.Key(bucket=bucket, name=key.name)
+        data = part_key.get_contents_as_string(headers={
+            'Range': 'bytes={}-{}'.format(offset, offset + length - 1)
+        })
+        if len(data) != length:
+            raise ValueError('Expected {} bytes at offset {} of {}, got {}'.format(
+                length, offset, key.name, len(data)
+            ))
+        with open(out_filename, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        progress.add(length)
+        return hashlib.md5(data).digest()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        part_digests = list(executor.map(download_part, _part_ranges(key.size, part_size)))
+    progress.log_throughput('downloaded {} in {} parts'.format(key.name, len(part_digests)))
+    return part_digests
+
+
+def _verify_download(key, filename, part_size, part_digests=None):
+    """Check a downloaded file against the object's ETag, which is the MD5
+    of the content, or for multipart uploads, of the parts' MD5s"""
+    if key.encrypted and key.encrypted != 'AES256':
+        logging.info('Not verifying %s, which is encrypted with %s', key.name, key.encrypted)
+        return
+    etag = key.etag.strip('"')
+    if '-' not in etag:
+        digest = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(part_size), b''):
+                digest.update(block)
+        expected = digest.hexdigest()
+    else:
+        upload_part_size = key.get_metadata(PART_SIZE_METADATA)
+        if upload_part_size is None:
+            logging.info('Not verifying %s, which was uploaded with an unknown part size', key.name)
+            return
+        upload_part_size = int(upload_part_size)
+        if part_digests is None or upload_part_size != part_size:
+            with open(filename, 'rb') as f:
+                part_digests = [
+                    hashlib.md5(block).digest()
+                    for block in iter(lambda: f.read(upload_part_size), b'')
+                ]
+        expected = _multipart_etag(part_digests)
+    if expected != etag:
+        raise ValueError('Checksum mismatch downloading {}'.format(key.name))
 
 
-def log_download_progress(num_bytes, obj_size):
-    """Callback that boto can use to log download or upload progress"""
-    logging.info('%s bytes transferred out of %s total', num_bytes, obj_size)
+def list_files(s3_conn, s3_path):
+    """Returns: (list) the names, without prefixes, of the files under an s3 path"""
+    files = [s3_file.name.split('/')[-1] for s3_file in iter_files(s3_conn, s3_path)]
+    return list(filter(None, files))
 
 
-def list_files(s3_conn, s3_path):
+S3File = namedtuple('S3File', ['name', 'size', 'etag', 'last_modified'])
+
+
+def _s3_file(key):
+    return S3File(key.name, key.size, key.etag.strip('"'), key.last_modified)
+
+
+def iter_files(s3_conn, s3_path, concurrency=1, delimiter='/'):
+    """Lists the objects under an s3 path, fetching one page of keys at a time
+
+    With concurrency above 1, the listing is split by the sub-prefixes found
+    with delimiter (e.g. one per quarter or partner), and up to concurrency
+    sub-prefixes are listed at once. Objects then come in no particular order.
+
+    Args:
+        s3_conn (boto.s3.connection) a boto s3 connection
+        s3_path (str) the bucket and prefix to list
+        concurrency (int) how many sub-prefixes to list at once
+        delimiter (str) what separates sub-prefixes
+
+    Yields: (S3File) the full name, size, ETag and last-modified time of each object
+    """
     bucket_name, prefix = split_s3_path(s3_path)
     bucket = s3_conn.get_bucket(bucket_name)
-    key = boto.s3.key.Key(
-        bucket=bucket,
-        name=prefix
-    )
-    files = []
-    for key in bucket.list(prefix=prefix):
-        files.append(key.name.split('/')[-1])
-    return list(filter(None, files))
+    if concurrency <= 1:
+        for key in bucket.list(prefix=prefix):
+            yield _s3_file(key)
+        return
+    sub_prefixes = []
+    for item in bucket.list(prefix=prefix, delimiter=delimiter):
+        if isinstance(item, boto.s3.prefix.Prefix):
+            sub_prefixes.append(item.name)
+        else:
+            yield _s3_file(item)
+    logging.info('Listing %d prefixes under %s in parallel', len(sub_prefixes), s3_path)
+    yield from _iter_prefixes(bucket, sub_prefixes, concurrency)
+
+
+def _iter_prefixes(bucket, prefixes, concurrency):
+    """List several prefixes from a thread pool, yielding objects as they arrive"""
+    results = queue.Queue(maxsize=LISTING_BUFFER_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def list_prefix(prefix):
+        if stopped.is_set():
+            return
+        try:
+            for key in bucket.list(prefix=prefix):
+                if stopped.is_set():
+                    return
+                put(_s3_file(key))
+        except Exception as e:
+            put(e)
+        finally:
+            put(_LISTING_DONE)
+
+    executor = ThreadPoolExecutor(concurrency)
+    futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+    try:
+        remaining = len(prefixes)
+        while remaining:
+            item = results.get()
+            if item is _LISTING_DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stopped.set()
+        # don't wait for listings that have not started
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def stream_json_lines(
+    s3_conn,
+    s3_path,
+    block_size=READ_AHEAD_BLOCK_SIZE,
+    read_ahead=READ_AHEAD_BLOCKS,
+    **kwargs
+):
+    """Stream JSON objects from a JSON-per-line object on s3, possibly
+    gzip, bz2 or zstd-compressed, without downloading it to disk first
+
+    Args:
+        s3_conn (boto.s3.connection) a boto s3 connection
+        s3_path (str) the source path on s3
+        block_size (int) bytes per ranged GET
+        read_ahead (int) how many blocks to fetch ahead of parsing
+        **kwargs passed on to io.stream_json_file, e.g. processes
+
+    Yields:
+        (dict) JSON objects
+    """
+    bucket_name, prefix = split_s3_path(s3_path)
+    bucket = s3_conn.get_bucket(bucket_name)
+    key = bucket.get_key(prefix)
+    if key is None:
+        raise boto.exception.S3ResponseError(404, 'Not Found', 'No such key {}'.format(s3_path))
+    with S3StreamReader(key, block_size, read_ahead) as reader:
+        yield from stream_json_file(open_json_lines(reader), **kwargs)
+
+
+class S3StreamReader(object):
+    """A readable binary stream over an s3 object. A background thread
+    fetches it in ranged GETs, staying up to read_ahead blocks ahead of
+    the reader so that network transfer overlaps with processing
+
+    Each GET is conditional on the object's ETag, so an object replaced
+    while being read raises an error instead of returning mixed contents.
+
+    Args:
+        key (boto.s3.key.Key) the object, with its size and ETag, as returned by bucket.get_key
+        block_size (int) bytes per ranged GET
+        read_ahead (int) how many blocks to fetch ahead of the reader
+    """
+    def __init__(self, key, block_size=READ_AHEAD_BLOCK_SIZE, read_ahead=READ_AHEAD_BLOCKS):
+        self.key = key
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=read_ahead)
+        self.block = b''
+        self.offset = 0
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fetch_blocks, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _fetch_blocks(self):
+        try:
+            for start in range(0, self.key.size, self.block_size):
+                if self.stopped.is_set():
+                    return
+                end = min(start + self.block_size, self.key.size) - 1
+                block_key = boto.s3.key.Key(bucket=self.key.bucket, name=self.key.name)
+                self._put(block_key.get_contents_as_string(headers={
+                    'Range': 'bytes={}-{}'.format(start, end),
+                    'If-Match': self.key.etag,
+                }))
+            self._put(b'')
+        except Exception as e:
+            self._put(e)
+
+    def _next_block(self):
+        """Wait for the next block. Returns: (bool) False at the end of the object"""
+        if self.finished:
+            return False
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            self.finished = True
+            raise block
+        if not block:
+            self.finished = True
+            return False
+        self.block = block
+        self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.key.size
+        chunks = []
+        while size > 0:
+            if self.offset >= len(self.block) and not self._next_block():
+                break
+            chunk = self.block[self.offset:self.offset + size]
+            self.offset += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class S3BackedJsonDict(MutableMapping):
@@ -121,8 +617,8 @@ class S3BackedJsonDict(MutableMapping):
 
         if self.fs.exists(self.path):
             with self.fs.open(self.path, 'rb') as f:
-                data = f.read().decode('utf-8') or '{}'
-                self._storage = json.loads(data)
+                data = f.read() or b'{}'
+                self._storage = serialization.loads(data)
         else:
             self._storage = dict()
 
@@ -158,8 +654,8 @@ class S3BackedJsonDict(MutableMapping):
         logging.info('Attempting to save storage of length %s to %s', len(self), self.path)
         if self.fs.exists(self.path):
             with self.fs.open(self.path, 'rb') as f:
-                saved_string = f.read().decode('utf-8') or '{}'
-                saved_data = json.loads(saved_string)
+                saved_string = f.read() or b'{}'
+                saved_data = serialization.loads(saved_string)
                 logging.info(
                     'Merging %s in-memory keys with %s stored keys. In-memory data takes priority',
                     len(self),
@@ -168,4 +664,4 @@ class S3BackedJsonDict(MutableMapping):
                 saved_data.update(self._storage)
                 self._storage = saved_data
         with self.fs.open(self.path, 'wb') as f:
-            f.write(json.dumps(self._storage).encode('utf-8'))
+            f.write(serialization.dumps_bytes(self._storage))
@@ -0,0 +1,150 @@
+"""JSON serialization utilities
+
+Selects the fastest available JSON library (orjson, then ujson, then the
+standard library json module) for use throughout skills_utils. Set the
+environment variable SKILLS_UTILS_JSON_BACKEND, or call set_backend,
+to force a particular one.
+
+All backends read back what any of them wrote, including integers wider
+than 64 bits, which are handed to the standard library. The one exception
+is NaN and Infinity: orjson writes them as null, so use the 'json' backend
+where those must round-trip.
+"""
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+PREFERRED_BACKENDS = ['orjson', 'ujson', 'json']
+BACKEND_NAME = os.getenv('SKILLS_UTILS_JSON_BACKEND')
+
+
+class JsonBackend(object):
+    """A JSON library, wrapped in a common interface
+
+    Args:
+        name (str) The name of the library
+        loads (function) Deserializes a str or bytes
+        dumps (function) Serializes an object to a str
+        dumps_bytes (function) Serializes an object to UTF-8 bytes
+    """
+    def __init__(self, name, loads, dumps, dumps_bytes):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.dumps_bytes = dumps_bytes
+
+    def __repr__(self):
+        return 'JsonBackend({})'.format(self.name)
+
+
+# orjson parses integers outside 64 bits as floats, so documents with a run
+# of this many digits, which might be one, are read with json instead. The
+# digits are found by mapping each to 0 (and everything else to a space)
+# and searching for a run of zeros, which is much faster than a regex
+_LONG_DIGITS = b'0' * 19
+_DIGITS_TABLE = bytes(ord('0') if i in b'0123456789' else ord(' ') for i in range(256))
+
+
+def _orjson_loads(data):
+    encoded = data.encode('utf-8') if isinstance(data, str) else data
+    if _LONG_DIGITS in encoded.translate(_DIGITS_TABLE):
+        return json.loads(data)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # e.g. NaN or Infinity, written by json
+        return json.loads(data)
+
+
+def _ujson_loads(data):
+    try:
+        return ujson.loads(data)
+    except ValueError:
+        # ujson rejects integers over 64 bits, NaN and Infinity
+        return json.loads(data)
+
+
+def _orjson_dumps_bytes(obj):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # orjson is stricter than json (e.g. integers over 64 bits)
+        return json.dumps(obj).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return _orjson_dumps_bytes(obj).decode('utf-8')
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj)
+    except (TypeError, OverflowError):
+        return json.dumps(obj)
+
+
+def _json_dumps_bytes(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def available_backends():
+    """Returns: (list) names of the installed JSON libraries, fastest first"""
+    installed = {'orjson': orjson, 'ujson': ujson, 'json': json}
+    return [name for name in PREFERRED_BACKENDS if installed[name] is not None]
+
+
+def get_backend(name=None):
+    """Build a JsonBackend
+
+    Args:
+        name (str, optional) One of 'orjson', 'ujson' or 'json'.
+            Defaults to the fastest installed library
+
+    Returns: (JsonBackend)
+    """
+    name = name or available_backends()[0]
+    if name not in available_backends():
+        raise ValueError('JSON backend {} is not available'.format(name))
+    if name == 'orjson':
+        return JsonBackend(name, _orjson_loads, _orjson_dumps, _orjson_dumps_bytes)
+    if name == 'ujson':
+        return JsonBackend(
+            name,
+            _ujson_loads,
+            _ujson_dumps,
+            lambda obj: _ujson_dumps(obj).encode('utf-8')
+        )
+    return JsonBackend(name, json.loads, json.dumps, _json_dumps_bytes)
+
+
+def set_backend(name=None):
+    """Change the JSON library used by the module-level functions
+
+    Args:
+        name (str, optional) One of 'orjson', 'ujson' or 'json'.
+            Defaults to the fastest installed library
+
+    Returns: (JsonBackend) the new backend
+    """
+    global backend, loads, dumps, dumps_bytes
+    backend = get_backend(name)
+    loads = backend.loads
+    dumps = backend.dumps
+    dumps_bytes = backend.dumps_bytes
+    logging.debug('Using JSON backend %s', backend.name)
+    return backend
+
+
+backend = loads = dumps = dumps_bytes = None
+set_backend(BACKEND_NAME)
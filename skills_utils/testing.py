@@ -1,16 +1,14 @@
 """Testing utilities"""
-from skills_utils.job_posting_import import JobPostingImportBase
+from skills_utils import serialization
+from skills_utils.job_posting_import import JobPostingImportBase, MANDATORY_FIELDS
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import random
+import threading
+import time
 import unittest
 
-MANDATORY_FIELDS = [
-    'title',
-    'description',
-    'datePosted',
-    'validThrough',
-    'jobLocation',
-]
-
 
 class SampleImporter(JobPostingImportBase):
     """A basic importer that can be run through the ImporterTest"""
@@ -39,3 +37,253 @@ class ImporterTest(unittest.TestCase):
         assert transformed['@type'] == 'JobPosting'
         for field in MANDATORY_FIELDS:
             assert field in transformed
+
+
+class _FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Routes requests to the FakeElasticsearchServer that owns the HTTP server"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = [part for part in urlparse(self.path).path.split('/') if part]
+        status, response = self.server.fake.handle(self.command, path, body)
+        data = b'' if response is None else serialization.dumps_bytes(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+
+class FakeElasticsearchServer(object):
+    """A local stand-in for an Elasticsearch cluster, for testing and
+    benchmarking indexing code without a live cluster
+
+    Implements the bulk, single-document index, index creation and deletion,
+    alias, settings, refresh, force merge and cluster health endpoints that
+    skills_utils.es uses, with configurable latency and rejections.
+
+        with FakeElasticsearchServer(latency=0.01, rejection_rate=0.05) as server:
+            client = Elasticsearch([server.host])
+
+    Args:
+        latency (float) Seconds to wait before responding to each request
+        latency_per_document (float) Additional seconds per document in a bulk request
+        rejection_rate (float) Fraction of bulk documents rejected with a 429
+        bulk_rejection_rate (float) Fraction of whole bulk requests rejected with a 429
+        store_documents (bool) Whether to keep indexed documents, or only count them
+        seed (int) Seed for choosing which requests and documents to reject
+    """
+    def __init__(
+        self,
+        latency=0,
+        latency_per_document=0,
+        rejection_rate=0,
+        bulk_rejection_rate=0,
+        store_documents=True,
+        seed=0
+    ):
+        self.latency = latency
+        self.latency_per_document = latency_per_document
+        self.rejection_rate = rejection_rate
+        self.bulk_rejection_rate = bulk_rejection_rate
+        self.store_documents = store_documents
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.indices = {}
+        self.aliases = {}
+        self.bulk_requests = 0
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def host(self):
+        """The host:port the server is listening on"""
+        return 'localhost:{}'.format(self.httpd.server_address[1])
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('localhost', 0), _FakeElasticsearchHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def document_count(self, index_or_alias):
+        """Returns: (int) how many documents an index, or the index an alias points to, holds"""
+        index_name = self.aliases.get(index_or_alias, index_or_alias)
+        return self.indices[index_name]['count']
+
+    def settings(self, index_or_alias):
+        """Returns: (dict) the effective settings of an index, with flat
+        'index.' prefixed names, as Elasticsearch applies them"""
+        index_name = self.aliases.get(index_or_alias, index_or_alias)
+        return dict(self.indices[index_name]['settings'])
+
+    @staticmethod
+    def _flat_settings(settings, prefix=''):
+        """Flatten nested settings into 'index.' prefixed names, so
+        {'index': {'refresh_interval': '1s'}} and {'refresh_interval': '1s'}
+        both set index.refresh_interval"""
+        flat = {}
+        for name, value in settings.items():
+            name = prefix + name
+            if isinstance(value, dict):
+                flat.update(FakeElasticsearchServer._flat_settings(value, name + '.'))
+                continue
+            if not name.startswith('index.'):
+                name = 'index.' + name
+            flat[name] = value
+        return flat
+
+    def _error(self, status, error_type):
+        return status, {'error': {'type': error_type}, 'status': status}
+
+    def handle(self, method, path, body):
+        """Respond to a request
+
+        Args:
+            method (str) The HTTP method
+            path (list) The non-empty components of the URL path
+            body (bytes) The request body
+
+        Returns: (tuple) the HTTP status and the JSON-serializable response, if any
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if not path:
+            return 200, {'version': {'number': '6.8.0'}, 'tagline': 'You Know, for Search'}
+        if path[-1] == '_bulk':
+            return self._bulk(body)
+        with self.lock:
+            return self._handle_admin(method, path, body)
+
+    def _handle_admin(self, method, path, body):
+        request = serialization.loads(body) if body else {}
+        if path[0] == '_aliases':
+            for action in request['actions']:
+                for op_type, alias in action.items():
+                    if op_type == 'add':
+                        self.aliases[alias['alias']] = alias['index']
+                    elif self.aliases.get(alias['alias']) == alias['index']:
+                        del self.aliases[alias['alias']]
+            return 200, {'acknowledged': True}
+        if path[0] == '_alias':
+            if path[1] not in self.aliases:
+                return 404, {}
+            return 200, {self.aliases[path[1]]: {'aliases': {path[1]: {}}}}
+        if path[0] == '_cluster':
+            return 200, {'status': 'green', 'timed_out': False}
+        index_name = path[0]
+        if len(path) == 1:
+            if method == 'PUT':
+                if index_name in self.indices:
+                    return self._error(400, 'resource_already_exists_exception')
+                self.indices[index_name] = {
+                    'settings': self._flat_settings(request.get('settings', {})),
+                    'mappings': request.get('mappings', {}),
+                    'documents': {},
+                    'count': 0,
+                }
+                return 200, {'acknowledged': True, 'index': index_name}
+            if method == 'DELETE':
+                if self.indices.pop(index_name, None) is None:
+                    return self._error(404, 'index_not_found_exception')
+                return 200, {'acknowledged': True}
+            if method == 'HEAD':
+                return (200 if index_name in self.indices else 404), None
+        index_name = self.aliases.get(index_name, index_name)
+        if index_name not in self.indices:
+            return self._error(404, 'index_not_found_exception')
+        index = self.indices[index_name]
+        if path[1] == '_settings':
+            if method == 'PUT':
+                index['settings'].update(self._flat_settings(request))
+                return 200, {'acknowledged': True}
+            return 200, {index_name: {'settings': index['settings']}}
+        if path[1] in ('_refresh', '_forcemerge'):
+            return 200, {'_shards': {'failed': 0}}
+        if len(path) == 3 and method in ('PUT', 'POST'):
+            created = self._store(index, path[2], request)
+            return 201 if created else 200, {
+                '_index': index_name,
+                '_id': path[2],
+                'result': 'created' if created else 'updated',
+            }
+        return self._error(400, 'unsupported_fake_request')
+
+    def _store(self, index, document_id, source):
+        """Returns: (bool) whether the document is new"""
+        documents = index['documents']
+        created = document_id not in documents
+        if created:
+            index['count'] += 1
+        documents[document_id] = source if self.store_documents else None
+        return created
+
+    def _bulk(self, body):
+        lines = iter(body.splitlines())
+        operations = []
+        for line in lines:
+            if not line.strip():
+                continue
+            op_type, meta = next(iter(serialization.loads(line).items()))
+            source = None if op_type == 'delete' else serialization.loads(next(lines))
+            operations.append((op_type, meta, source))
+        if self.latency_per_document:
+            time.sleep(self.latency_per_document * len(operations))
+        items = []
+        with self.lock:
+            self.bulk_requests += 1
+            if self.random.random() < self.bulk_rejection_rate:
+                return self._error(429, 'es_rejected_execution_exception')
+            for op_type, meta, source in operations:
+                items.append({op_type: self._bulk_operation(op_type, meta, source)})
+        return 200, {
+            'took': 1,
+            'errors': any(next(iter(item.values()))['status'] >= 300 for item in items),
+            'items': items,
+        }
+
+    def _bulk_operation(self, op_type, meta, source):
+        index_name = self.aliases.get(meta['_index'], meta['_index'])
+        result = {'_index': index_name, '_id': meta.get('_id')}
+        if self.random.random() < self.rejection_rate:
+            result.update(status=429, error={'type': 'es_rejected_execution_exception'})
+        elif index_name not in self.indices:
+            result.update(status=404, error={'type': 'index_not_found_exception'})
+        elif op_type == 'delete':
+            index = self.indices[index_name]
+            if index['documents'].pop(meta['_id'], False) is False:
+                result.update(status=404, result='not_found')
+            else:
+                index['count'] -= 1
+                result.update(status=200, result='deleted')
+        else:
+            document_id = meta.get('_id') or str(self.random.getrandbits(64))
+            created = self._store(self.indices[index_name], document_id, source)
+            result.update(_id=document_id, status=201 if created else 200)
+        return result
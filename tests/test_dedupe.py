@@ -0,0 +1,68 @@
+from skills_utils.dedupe import BloomFilter, ContentHashStore, HashSet
+from skills_utils.hash import hash64
+
+
+def test_hash64():
+    assert hash64('xx_1') == hash64('xx_1')
+    assert hash64('xx_1') != hash64('xx_2')
+    assert 0 <= hash64('xx_1') < 2 ** 64
+
+
+def test_HashSet(tmpdir):
+    seen = HashSet()
+    seen.MIN_PENDING = 10
+    assert all(seen.add('xx_{}'.format(i)) for i in range(100))
+    assert not seen.add('xx_5')
+    assert 'xx_99' in seen
+    assert 'xx_100' not in seen
+    assert len(seen) == 100
+
+    path = str(tmpdir.join('seen.bin'))
+    seen.save(path)
+    loaded = HashSet.load(path)
+    assert len(loaded) == 100
+    assert 'xx_42' in loaded
+    assert len(HashSet.load(str(tmpdir.join('missing.bin')))) == 0
+
+
+def test_BloomFilter(tmpdir):
+    seen = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        seen.add('xx_{}'.format(i))
+    assert all('xx_{}'.format(i) in seen for i in range(10000))
+    false_positives = sum('yy_{}'.format(i) in seen for i in range(10000))
+    assert false_positives < 300
+
+    path = str(tmpdir.join('seen.bloom'))
+    seen.save(path)
+    loaded = BloomFilter.load(path, capacity=10)
+    assert loaded.num_bits == seen.num_bits
+    assert 'xx_1234' in loaded
+    assert not loaded.add('xx_1234')
+
+
+def test_ContentHashStore(tmpdir):
+    store = ContentHashStore(keep_keys=True)
+    assert all(store.stage('doc_{}'.format(i), i) for i in range(10))
+    store.unstage('doc_9')
+    store.commit()
+    assert len(store) == 9
+
+    path = str(tmpdir.join('hashes.bin'))
+    store.save(path)
+    loaded = ContentHashStore.load(path, keep_keys=True)
+    assert not loaded.stage('doc_1', 1)
+    assert loaded.stage('doc_2', 20)
+    assert loaded.stage('doc_9', 9)
+    assert loaded.stage('doc_10', 10)
+    loaded.keep('doc_3')
+    assert sorted(loaded.unseen()) == ['doc_0', 'doc_4', 'doc_5', 'doc_6', 'doc_7', 'doc_8']
+    loaded.commit(drop_unseen=True)
+    assert sorted(loaded.keys) == ['doc_1', 'doc_10', 'doc_2', 'doc_3', 'doc_9']
+    assert not loaded.stage('doc_2', 20)
+    assert loaded.stage('doc_3', 30)
+
+    without_keys = ContentHashStore.load(path)
+    assert without_keys.keys is None
+    assert not without_keys.stage('doc_8', 8)
+    assert len(ContentHashStore.load(str(tmpdir.join('missing.bin')))) == 0
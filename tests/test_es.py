@@ -0,0 +1,394 @@
+from skills_utils.es import ElasticsearchIndexerBase, basic_client, get_client, indices_client
+from skills_utils.testing import FakeElasticsearchServer
+from elasticsearch import ConnectionError, Elasticsearch
+from elasticsearch.serializer import JSONSerializer
+from datetime import date
+from decimal import Decimal
+import json
+import os
+import pytest
+import socket
+import threading
+from unittest.mock import MagicMock, patch
+
+
+class FakeBulkClient(object):
+    """Stands in for an Elasticsearch client, recording bulk requests"""
+    def __init__(self, statuses=None):
+        self.statuses = statuses or {}
+        self.transport = type('Transport', (object,), {'serializer': JSONSerializer()})()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        lines = body.strip().split('\n')
+        with self.lock:
+            self.requests.append(lines)
+        items = []
+        for action in self.actions(lines):
+            op_type, meta = next(iter(action.items()))
+            statuses = self.statuses.get(meta['_id'])
+            status = statuses.pop(0) if statuses else 201
+            items.append({op_type: {'_id': meta['_id'], 'status': status}})
+        return {'errors': False, 'items': items}
+
+    @staticmethod
+    def actions(lines):
+        lines = iter(lines)
+        for line in lines:
+            action = json.loads(line)
+            if 'delete' not in action:
+                next(lines)
+            yield action
+
+
+class SampleIndexer(ElasticsearchIndexerBase):
+    alias_name = 'sample'
+    settings = {}
+    mappings = {}
+
+    def __init__(self, es_client, num_documents=50):
+        super(SampleIndexer, self).__init__(None, es_client)
+        self.document_ids = range(num_documents)
+        self.texts = {}
+
+    def _iter_documents(self, target_index):
+        for i in self.document_ids:
+            yield {
+                '_op_type': 'index',
+                '_index': target_index,
+                '_type': 'document',
+                '_id': str(i),
+                '_source': {'id': i, 'text': self.texts.get(i, 'x' * 100)},
+            }
+
+
+def test_index_all():
+    client = FakeBulkClient()
+    indexer = SampleIndexer(client)
+    indexer.BULK_CHUNK_SIZE = 20
+    assert indexer.index_all('sample_1') == (50, 0)
+    assert [len(request) // 2 for request in client.requests] == [20, 20, 10]
+
+
+def test_index_all_parallel_byte_bounded():
+    client = FakeBulkClient()
+    indexer = SampleIndexer(client)
+    indexer.BULK_THREADS = 3
+    indexer.BULK_MAX_CHUNK_BYTES = 1000
+    assert indexer.index_all('sample_1') == (50, 0)
+    assert len(client.requests) > 1
+    assert all(len('\n'.join(request)) <= 1000 for request in client.requests)
+    ids = sorted(json.loads(line)['index']['_id'] for request in client.requests for line in request[::2])
+    assert ids == sorted(str(i) for i in range(50))
+
+
+def test_replace_bulk_load():
+    client = FakeBulkClient()
+    indices = MagicMock()
+    indices.exists_alias.return_value = False
+    indices.client.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+    indexer = SampleIndexer(client)
+    indexer.settings = {'index': {'number_of_replicas': 2, 'number_of_shards': 3}}
+    indexer.BULK_LOAD = True
+    indexer.FORCE_MERGE_SEGMENTS = 1
+    with patch('skills_utils.es.indices_client', return_value=indices):
+        indexer.replace()
+
+    created = indices.create.call_args[1]
+    assert created['body']['settings'] == {'index': {
+        'number_of_replicas': 0,
+        'number_of_shards': 3,
+        'refresh_interval': '-1',
+    }}
+    assert indexer.settings['index']['number_of_replicas'] == 2
+    temporary_name = created['index']
+    indices.put_settings.assert_called_with(
+        index=temporary_name,
+        body={'index': {'refresh_interval': '1s', 'number_of_replicas': 2}}
+    )
+    assert indices.forcemerge.call_args[1]['max_num_segments'] == 1
+    assert indices.client.cluster.health.call_args[1]['wait_for_status'] == 'green'
+    indices.update_aliases.assert_called_once()
+    indices.delete.assert_not_called()
+
+
+def test_replace_bulk_load_not_healthy():
+    client = FakeBulkClient()
+    indices = MagicMock()
+    indices.client.cluster.health.return_value = {'status': 'yellow', 'timed_out': True}
+    indexer = SampleIndexer(client)
+    indexer.BULK_LOAD = True
+    with patch('skills_utils.es.indices_client', return_value=indices):
+        indexer.replace()
+    indices.update_aliases.assert_not_called()
+    indices.delete.assert_called_once()
+
+
+def test_index_all_retries_and_dead_letters(tmpdir):
+    client = FakeBulkClient(statuses={
+        '3': [429],
+        '4': [503, 429],
+        '5': [400],
+        '6': [429, 429, 429],
+    })
+    indexer = SampleIndexer(client, num_documents=10)
+    indexer.BULK_MAX_RETRIES = 2
+    indexer.BULK_INITIAL_BACKOFF = 0
+    indexer.BULK_CHUNK_SIZE = 8
+    indexer.BULK_MIN_CHUNK_SIZE = 1
+    indexer.DEAD_LETTER_PATH = str(tmpdir.join('dead_letters.json'))
+    assert indexer.index_all('sample_1') == (8, 2)
+    assert [len(request) // 2 for request in client.requests] == [8, 5, 2]
+
+    with open(indexer.DEAD_LETTER_PATH) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [(letter['action']['_id'], letter['status']) for letter in dead_letters] == [
+        ('5', 400),
+        ('6', 429),
+    ]
+
+    replay_path = str(tmpdir.join('replay.json'))
+    os.rename(indexer.DEAD_LETTER_PATH, replay_path)
+    assert indexer.replay_dead_letters(replay_path, index_name='sample_2') == (2, 0)
+    assert json.loads(client.requests[-1][0])['index']['_index'] == 'sample_2'
+
+
+def request_ids(client):
+    return [[json.loads(line)['index']['_id'] for line in request[::2]] for request in client.requests]
+
+
+def test_index_all_feeds_retries_back_after_backoff():
+    client = FakeBulkClient(statuses={'0': [429]})
+    indexer = SampleIndexer(client, num_documents=7)
+    indexer.BULK_MAX_RETRIES = 1
+    indexer.BULK_INITIAL_BACKOFF = 5
+    indexer.BULK_CHUNK_SIZE = 2
+    indexer.BULK_MIN_CHUNK_SIZE = 1
+    with patch('skills_utils.es.time.sleep') as sleep:
+        assert indexer.index_all('sample_1') == (7, 0)
+    # still backing off, the rejected document is retried after the rest
+    assert request_ids(client) == [['0', '1'], ['2', '3'], ['4', '5'], ['6'], ['0']]
+    assert 4 < sleep.call_args[0][0] <= 5
+
+    # with too many retries pending, they are sent before more documents are read
+    client = FakeBulkClient(statuses={'0': [429]})
+    indexer.es_client = client
+    indexer.BULK_MAX_PENDING_RETRIES = 1
+    with patch('skills_utils.es.time.sleep') as sleep:
+        assert indexer.index_all('sample_1') == (7, 0)
+    assert request_ids(client) == [['0', '1'], ['2', '0'], ['3', '4'], ['5', '6']]
+    assert 4 < sleep.call_args[0][0] <= 5
+
+
+def test_index_all_streams_without_retries():
+    client = FakeBulkClient()
+    indexer = SampleIndexer(client, num_documents=50)
+    indexer.BULK_CHUNK_SIZE = 5
+    read = []
+    iter_documents = indexer._iter_documents
+
+    def counted(target_index):
+        for action in iter_documents(target_index):
+            read.append(len(client.requests))
+            yield action
+
+    indexer._iter_documents = counted
+    assert indexer.index_all('sample_1') == (50, 0)
+    # documents are read as they are sent, not a segment at a time. Each
+    # chunk is sent once the first document of the next one has been read
+    assert read == [max(0, (i - 1) // 5) for i in range(50)]
+
+
+def test_index_all_warns_when_dropping(caplog):
+    client = FakeBulkClient(statuses={'2': [400], '3': [429]})
+    indexer = SampleIndexer(client, num_documents=5)
+    assert indexer.index_all('sample_1') == (3, 2)
+    assert '2 documents could not be indexed and were dropped' in caplog.text
+
+
+def test_dead_letters_with_non_json_values(tmpdir):
+    class DecimalIndexer(SampleIndexer):
+        def _iter_documents(self, target_index):
+            yield {
+                '_index': target_index,
+                '_id': '1',
+                '_source': {'salary': Decimal('51000.50'), 'posted': date(2017, 1, 2)},
+            }
+
+    indexer = DecimalIndexer(FakeBulkClient(statuses={'1': [400]}))
+    indexer.DEAD_LETTER_PATH = str(tmpdir.join('dead_letters.json'))
+    assert indexer.index_all('sample_1') == (0, 1)
+    with open(indexer.DEAD_LETTER_PATH) as f:
+        assert json.loads(f.read())['action']['_source'] == {
+            'salary': 51000.5,
+            'posted': '2017-01-02',
+        }
+
+
+def test_index_all_parallel_retries():
+    client = FakeBulkClient(statuses={str(i): [429] for i in range(0, 50, 7)})
+    indexer = SampleIndexer(client)
+    indexer.BULK_THREADS = 3
+    indexer.BULK_CHUNK_SIZE = 5
+    indexer.BULK_MAX_RETRIES = 1
+    indexer.BULK_INITIAL_BACKOFF = 0
+    assert indexer.index_all('sample_1') == (50, 0)
+    ids = [json.loads(line)['index']['_id'] for request in client.requests for line in request[::2]]
+    assert sorted(ids, key=int) == sorted(
+        [str(i) for i in range(50)] + [str(i) for i in range(0, 50, 7)],
+        key=int
+    )
+
+
+def fake_indices_client():
+    """An indices client mock that keeps track of aliases"""
+    indices = MagicMock()
+    aliases = {}
+
+    def update_aliases(body):
+        for action in body['actions']:
+            if 'add' in action:
+                aliases[action['add']['alias']] = action['add']['index']
+
+    indices.update_aliases.side_effect = update_aliases
+    indices.exists_alias.side_effect = lambda name: name in aliases
+    indices.get_alias.side_effect = lambda name: {aliases[name]: {}}
+    return indices
+
+
+def test_append_delta(tmpdir):
+    client = FakeBulkClient()
+    indices = fake_indices_client()
+    indexer = SampleIndexer(client, num_documents=10)
+    indexer.DELTA_STORE_PATH = str(tmpdir.join('hashes.bin'))
+    indexer.DELTA_DELETES = True
+    with patch('skills_utils.es.indices_client', return_value=indices):
+        indexer.append()
+        index_name = indices.create.call_args[1]['index']
+        assert sum(len(request) // 2 for request in client.requests) == 10
+
+        client.requests = []
+        indexer.document_ids = [i for i in range(12) if i != 4]
+        indexer.texts = {2: 'changed'}
+        indexer.append()
+    sent = [next(iter(action.items())) for action in client.actions(client.requests[0])]
+    assert [(op_type, meta['_id']) for op_type, meta in sent] == [
+        ('index', '2'),
+        ('index', '10'),
+        ('index', '11'),
+        ('delete', '4'),
+    ]
+    assert all(meta['_index'] == index_name for _, meta in sent)
+
+    client.requests = []
+    assert indexer.index_delta(index_name) == (0, 0)
+    assert client.requests == []
+
+
+def test_delta_delete_of_missing_document(tmpdir):
+    client = FakeBulkClient()
+    indexer = SampleIndexer(client, num_documents=5)
+    indexer.DELTA_STORE_PATH = str(tmpdir.join('hashes.bin'))
+    indexer.DELTA_DELETES = True
+    indexer.DEAD_LETTER_PATH = str(tmpdir.join('dead_letters.json'))
+    assert indexer.index_delta('sample_1') == (5, 0)
+
+    # already deleted from the index, so the delete is done
+    indexer.document_ids = range(4)
+    client.statuses = {'4': [404]}
+    assert indexer.index_delta('sample_1') == (1, 0)
+    with open(indexer.DEAD_LETTER_PATH) as f:
+        assert f.read() == ''
+
+    client.requests = []
+    assert indexer.index_delta('sample_1') == (0, 0)
+    assert client.requests == []
+
+
+def test_content_hash_ignores_key_order_and_index():
+    indexer = SampleIndexer(FakeBulkClient())
+    first = {'_index': 'sample_1', '_id': '1', '_source': {'a': 1, 'b': [1, 2]}}
+    second = {'_source': {'b': [1, 2], 'a': 1}, '_id': '1', '_index': 'sample_2'}
+    assert indexer._content_hash(first) == indexer._content_hash(second)
+    second['_source']['a'] = 2
+    assert indexer._content_hash(first) != indexer._content_hash(second)
+
+
+def test_get_client_cached_with_backoff():
+    attempts = []
+
+    def info(self):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError('N/A', 'refused', None)
+        return {}
+
+    with patch.object(Elasticsearch, 'info', info), patch('skills_utils.es.time.sleep') as sleep:
+        client = get_client(hosts=['fakehost:9200'], pool_size=3, max_backoff=1.5)
+        assert [call[0][0] for call in sleep.call_args_list] == [1, 1.5]
+        assert get_client(hosts=['fakehost:9200'], pool_size=3) is client
+        assert len(attempts) == 3
+
+    connection = client.transport.connection_pool.connections[0]
+    assert connection.pool.pool.maxsize == 3
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in connection.pool.conn_kw['socket_options']
+
+    with patch('skills_utils.es.HOSTNAME', 'fakehost:9200'), patch('skills_utils.es.POOL_SIZE', 3):
+        assert basic_client() is client
+        assert indices_client().transport is client.transport
+
+
+def test_get_client_gives_up():
+    with patch.object(Elasticsearch, 'info', side_effect=ConnectionError('N/A', 'refused', None)), \
+            patch('skills_utils.es.time.sleep'):
+        with pytest.raises(ConnectionError):
+            get_client(hosts=['unreachable:9200'], connect_attempts=2)
+
+
+def test_get_client_waits_outside_the_shared_lock():
+    waiting = threading.Event()
+    reachable = threading.Event()
+
+    def info(self):
+        if self.transport.hosts[0]['host'] == 'slowhost':
+            waiting.set()
+            assert reachable.wait(5)
+        return {}
+
+    with patch.object(Elasticsearch, 'info', info):
+        slow = threading.Thread(target=get_client, kwargs={'hosts': ['slowhost:9200']}, daemon=True)
+        slow.start()
+        try:
+            assert waiting.wait(5)
+            # another cluster's client is not held up by the one still waiting
+            fast = threading.Thread(target=get_client, kwargs={'hosts': ['fasthost:9200']}, daemon=True)
+            fast.start()
+            fast.join(2)
+            assert not fast.is_alive()
+        finally:
+            reachable.set()
+            slow.join()
+
+
+def test_replace_against_fake_server():
+    with FakeElasticsearchServer(rejection_rate=0.2, bulk_rejection_rate=0.1) as server:
+        with patch('skills_utils.es.HOSTNAME', server.host):
+            indexer = SampleIndexer(basic_client(), num_documents=200)
+            indexer.BULK_THREADS = 2
+            indexer.BULK_CHUNK_SIZE = 20
+            indexer.BULK_MAX_RETRIES = 10
+            indexer.BULK_INITIAL_BACKOFF = 0
+            indexer.BULK_LOAD = True
+            indexer.settings = {'number_of_replicas': 1}
+            indexer.replace()
+            first_index = server.aliases['sample']
+            assert server.document_count('sample') == 200
+            settings = server.settings(first_index)
+            assert settings['index.refresh_interval'] == '1s'
+            assert settings['index.number_of_replicas'] == 1
+
+            indexer.document_ids = range(10)
+            indexer.replace()
+            assert server.document_count('sample') == 10
+            assert first_index not in server.indices
@@ -0,0 +1,88 @@
+from skills_utils.es_async import AsyncElasticsearchIndexerBase
+from unittest.mock import patch
+import asyncio
+
+
+class FakeAsyncIndices(object):
+    def __init__(self):
+        self.aliases = {}
+        self.indices = set()
+        self.calls = []
+
+    async def create(self, index, body):
+        self.calls.append(('create', index))
+        self.indices.add(index)
+
+    async def delete(self, index):
+        self.calls.append(('delete', index))
+        self.indices.discard(index)
+
+    async def exists_alias(self, name):
+        return name in self.aliases
+
+    async def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    async def update_aliases(self, body):
+        self.calls.append(('update_aliases', body))
+        for action in body['actions']:
+            if 'add' in action:
+                self.aliases[action['add']['alias']] = action['add']['index']
+
+
+class FakeAsyncClient(object):
+    def __init__(self):
+        self.indices = FakeAsyncIndices()
+        self.documents = []
+
+
+async def fake_async_streaming_bulk(client, actions, **kwargs):
+    async for action in actions:
+        client.documents.append(action)
+        yield action['_id'] != 'bad', {'index': {'_id': action['_id']}}
+
+
+class SampleAsyncIndexer(AsyncElasticsearchIndexerBase):
+    alias_name = 'sample'
+    settings = {}
+    mappings = {}
+
+    async def _iter_documents(self, target_index):
+        for i in range(5):
+            await asyncio.sleep(0)
+            yield {'_index': target_index, '_id': str(i), '_source': {'id': i}}
+
+
+class SampleSyncSourceIndexer(SampleAsyncIndexer):
+    def _iter_documents(self, target_index):
+        yield {'_index': target_index, '_id': 'bad', '_source': {}}
+
+
+@patch('skills_utils.es_async.async_streaming_bulk', fake_async_streaming_bulk)
+def test_async_indexer_replace_and_append():
+    client = FakeAsyncClient()
+    indexer = SampleAsyncIndexer(None, client)
+    asyncio.run(indexer.append())
+    first_index = client.indices.aliases['sample']
+    assert [document['_id'] for document in client.documents] == ['0', '1', '2', '3', '4']
+    assert all(document['_index'] == first_index for document in client.documents)
+
+    asyncio.run(indexer.replace())
+    second_index = client.indices.aliases['sample']
+    assert second_index != first_index
+    assert client.indices.indices == {second_index}
+
+    assert asyncio.run(SampleSyncSourceIndexer(None, client).index_all(second_index)) == (0, 1)
+
+
+@patch('skills_utils.es_async.async_streaming_bulk', fake_async_streaming_bulk)
+def test_async_indexer_replace_failure():
+    class FailingIndexer(SampleAsyncIndexer):
+        async def _iter_documents(self, target_index):
+            yield {'_index': target_index, '_id': '0', '_source': {}}
+            raise ValueError('bad input')
+
+    client = FakeAsyncClient()
+    asyncio.run(FailingIndexer(None, client).replace())
+    assert client.indices.aliases == {}
+    assert client.indices.indices == set()
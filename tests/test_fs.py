@@ -1,4 +1,4 @@
-from skills_utils.fs import cache_json, CACHE_DIRECTORY, check_create_folder
+from skills_utils.fs import cache_json, CACHE_DIRECTORY, check_create_folder, read_bytes, write_bytes
 import os
 import json
 import shutil
@@ -29,3 +29,11 @@ def test_check_create_folder():
     check_create_folder(filename)
     assert os.path.exists(test_dir)
     shutil.rmtree(test_dir)
+
+
+def test_read_write_bytes(tmpdir):
+    path = str(tmpdir.join('nested', 'state.json'))
+    assert read_bytes(path) is None
+    write_bytes(path, b'{"a": 1}')
+    assert read_bytes(path) == b'{"a": 1}'
+    assert not os.path.exists(path + '.tmp')
@@ -0,0 +1,125 @@
+from skills_utils.io import stream_json_file, astream_json_file, stream_json_projection, open_json_lines, build_line_index, LineIndex, ShardedJsonLinesWriter
+import asyncio
+import bz2
+import gzip
+import io
+import json
+import logging
+import os
+
+
+def sample_lines():
+    lines = [json.dumps({'id': i}).encode('utf-8') for i in range(50)]
+    lines[7] = b'{not json'
+    return b'\n'.join(lines) + b'\n'
+
+
+def test_stream_json_file():
+    records = list(stream_json_file(io.BytesIO(sample_lines())))
+    assert [record['id'] for record in records] == [i for i in range(50) if i != 7]
+
+
+def test_stream_json_file_parallel(caplog):
+    with caplog.at_level(logging.WARNING):
+        records = list(stream_json_file(
+            io.BytesIO(sample_lines()),
+            processes=2,
+            chunk_size=64
+        ))
+    assert [record['id'] for record in records] == [i for i in range(50) if i != 7]
+    assert 'Skipping line 7' in caplog.text
+
+
+def test_stream_json_file_parallel_unordered():
+    records = list(stream_json_file(
+        io.BytesIO(sample_lines()),
+        processes=2,
+        ordered=False,
+        chunk_size=64
+    ))
+    assert sorted(record['id'] for record in records) == [i for i in range(50) if i != 7]
+
+
+def test_open_json_lines_compressed():
+    raw = sample_lines()
+    for compressed in (raw, gzip.compress(raw), bz2.compress(raw)):
+        reader = open_json_lines(io.BytesIO(compressed), block_size=100)
+        records = list(stream_json_file(reader))
+        assert [record['id'] for record in records] == [i for i in range(50) if i != 7]
+        assert reader.lines_read == 50
+        assert reader.bytes_read == len(raw)
+
+
+def test_open_json_lines_parallel():
+    reader = open_json_lines(io.BytesIO(gzip.compress(sample_lines())))
+    records = list(stream_json_file(reader, processes=2, chunk_size=64))
+    assert len(records) == 49
+
+
+def test_line_index(tmpdir):
+    path = str(tmpdir.join('postings.json'))
+    with open(path, 'wb') as f:
+        f.write(sample_lines())
+    index = build_line_index(path)
+    assert len(index) == 50
+    assert index.record(12) == {'id': 12}
+    assert [record['id'] for record in index.iter_range(5, 10)] == [5, 6, 8, 9]
+
+    shards = LineIndex(path).shards(3)
+    assert shards[0][0] == 0
+    assert shards[-1][1] == 50
+    assert all(end == start for (_, end), (start, _) in zip(shards, shards[1:]))
+    records = [record for shard in range(3) for record in index.iter_shard(shard, 3)]
+    assert [record['id'] for record in records] == [i for i in range(50) if i != 7]
+
+
+def test_stream_json_projection():
+    lines = b'\n'.join([
+        json.dumps({'id': 1, 'title': 'Nurse', 'location': {'city': 'Chicago'}, 'text': 'x' * 100}).encode('utf-8'),
+        json.dumps({'id': 2, 'title': 'Chef'}).encode('utf-8'),
+    ])
+    fields = ['title', ('location', 'city')]
+    assert list(stream_json_projection(io.BytesIO(lines), fields)) == [
+        ('Nurse', 'Chicago'),
+        ('Chef', None),
+    ]
+    projected = stream_json_projection(
+        io.BytesIO(lines),
+        {'title': 'title', 'city': ['location', 'city']},
+        processes=2
+    )
+    assert list(projected) == [
+        {'title': 'Nurse', 'city': 'Chicago'},
+        {'title': 'Chef', 'city': None},
+    ]
+
+
+def test_astream_json_file():
+    async def collect():
+        return [record async for record in astream_json_file(io.BytesIO(sample_lines()), block_size=64)]
+
+    records = asyncio.run(collect())
+    assert [record['id'] for record in records] == [i for i in range(50) if i != 7]
+
+
+def test_sharded_json_lines_writer(tmpdir):
+    uploaded = []
+    directory = str(tmpdir.join('2015Q1'))
+    writer = ShardedJsonLinesWriter(directory, max_bytes=100, upload=uploaded.append)
+    for i in range(30):
+        writer.write({'id': i, 'title': 'Nurse'})
+    manifest = writer.close()
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        assert json.load(f) == manifest
+    assert manifest['total_records'] == 30
+    assert sum(shard['records'] for shard in manifest['shards']) == 30
+    assert len(manifest['shards']) > 1
+    assert all(shard['bytes'] <= 100 for shard in manifest['shards'])
+    assert len(uploaded) == len(manifest['shards']) + 1
+    assert uploaded[-1].endswith('manifest.json')
+
+    records = []
+    for shard in manifest['shards']:
+        with open(os.path.join(directory, shard['filename']), 'rb') as f:
+            records.extend(stream_json_file(open_json_lines(f)))
+    assert records == [{'id': i, 'title': 'Nurse'} for i in range(30)]
@@ -1,4 +1,8 @@
-from skills_utils.iteration import Batch
+from skills_utils.iteration import Batch, MaterializedBatch, AsyncBatch, parallel_batch_map, BatchProcessingError
+import asyncio
+import pytest
+import threading
+import time
 
 
 def test_Batch():
@@ -14,3 +18,104 @@ def test_Batch():
     assert num_batches == 4
     assert len(final) == 100
     assert final == list(range(100))
+
+
+def test_MaterializedBatch_limit():
+    batches = list(MaterializedBatch(range(100), limit=30))
+    assert [len(batch) for batch in batches] == [30, 30, 30, 10]
+    assert sum(batches, []) == list(range(100))
+
+
+def test_MaterializedBatch_max_bytes():
+    items = ['a' * 40, 'b' * 40, 'c' * 40, 'd' * 200, 'e']
+    batches = list(MaterializedBatch(items, max_bytes=100))
+    assert batches == [['a' * 40, 'b' * 40], ['c' * 40], ['d' * 200], ['e']]
+
+
+def test_MaterializedBatch_max_wait():
+    def slow_source():
+        yield 1
+        yield 2
+        time.sleep(0.3)
+        yield 3
+
+    batches = list(MaterializedBatch(slow_source(), limit=10, max_wait=0.1))
+    assert batches == [[1, 2], [3]]
+
+
+def test_MaterializedBatch_max_wait_slow_first_item():
+    def slow_source():
+        time.sleep(0.2)
+        yield 1
+        time.sleep(1)
+        yield 2
+
+    start = time.monotonic()
+    batches = iter(MaterializedBatch(slow_source(), limit=10, max_wait=0.1))
+    assert next(batches) == [1]
+    assert time.monotonic() - start < 0.8
+    assert list(batches) == [[2]]
+
+
+def test_MaterializedBatch_max_wait_abandoned():
+    def endless_source():
+        while True:
+            yield 1
+
+    batches = iter(MaterializedBatch(endless_source(), limit=10, max_wait=1))
+    next(batches)
+    batches.close()
+    time.sleep(0.1)
+    assert 'MaterializedBatch-fill' not in [thread.name for thread in threading.enumerate()]
+
+
+def test_parallel_batch_map():
+    results = parallel_batch_map(sum, range(100), 10, workers=3, max_in_flight=2)
+    assert list(results) == [sum(range(start, start + 10)) for start in range(0, 100, 10)]
+    results = parallel_batch_map(sum, range(100), 10, ordered=False)
+    assert sorted(results) == [sum(range(start, start + 10)) for start in range(0, 100, 10)]
+
+
+def test_parallel_batch_map_max_wait():
+    flushed = threading.Event()
+
+    def stalled_source():
+        yield 1
+        # the partial batch must reach the pool while the source is stalled
+        flushed.wait(timeout=2)
+        yield 2
+
+    def record(batch):
+        if batch == [1]:
+            flushed.set()
+        return batch
+
+    results = list(parallel_batch_map(record, stalled_source(), 10, max_wait=0.1))
+    assert flushed.is_set()
+    assert results == [[1], [2]]
+
+
+def test_parallel_batch_map_error():
+    def fail_on_fifty(batch):
+        if 50 in batch:
+            raise ValueError('bad batch')
+        return len(batch)
+
+    with pytest.raises(BatchProcessingError) as excinfo:
+        list(parallel_batch_map(fail_on_fifty, range(100), 10, use_processes=False))
+    assert excinfo.value.batch_index == 5
+    assert isinstance(excinfo.value.error, ValueError)
+
+
+def test_AsyncBatch():
+    async def source():
+        for i in range(25):
+            yield i
+
+    async def collect(batcher):
+        return [batch async for batch in batcher]
+
+    assert asyncio.run(collect(AsyncBatch(source(), 10))) == [
+        list(range(10)), list(range(10, 20)), list(range(20, 25))
+    ]
+    assert asyncio.run(collect(AsyncBatch(range(5), 2, max_wait=1))) == [[0, 1], [2, 3], [4]]
@@ -1,6 +1,13 @@
 from skills_utils.testing import ImporterTest
 from skills_utils import JobPostingImportBase
+from skills_utils.job_posting_import import ImportCheckpoint, ImportStats
+from skills_utils.dedupe import HashSet
 from unittest.mock import MagicMock, call
+import asyncio
+import json
+import multiprocessing
+import pytest
+import time
 
 
 class PopulatedImporter(JobPostingImportBase):
@@ -32,3 +39,286 @@ def test_tracker():
         call(input_document={'one': 'two'}, output_document={'id': 'xx_two', 'title': 'two'}),
         call(input_document={'one': 'four'}, output_document={'id': 'xx_four', 'title': 'four'}),
     ])
+
+
+class AsyncImporter(PopulatedImporter):
+    """An importer whose raw postings come from an async generator"""
+    async def _iter_postings(self, quarter):
+        for document in super()._iter_postings(quarter):
+            await asyncio.sleep(0)
+            yield document
+
+
+def test_apostings():
+    async def collect(importer):
+        return [posting async for posting in importer.apostings('2015Q1')]
+
+    expected = [
+        {'id': 'xx_two', 'title': 'two'},
+        {'id': 'xx_four', 'title': 'four'}
+    ]
+    assert asyncio.run(collect(AsyncImporter(partner_id='xx'))) == expected
+    assert asyncio.run(collect(PopulatedImporter(partner_id='xx'))) == expected
+    with pytest.raises(TypeError):
+        list(AsyncImporter(partner_id='xx').postings('2015Q1'))
+
+
+class PartitionedImporter(JobPostingImportBase):
+    """An importer whose quarters are split into partitions"""
+    def _partitions(self, quarter):
+        return ['{}_{}'.format(quarter, part) for part in range(4)]
+
+    def _iter_partition_postings(self, partition):
+        for i in range(5):
+            yield {'one': '{}_{}'.format(partition, i)}
+
+    def _transform(self, document):
+        return {'title': document['one'].upper()}
+
+    def _id(self, document):
+        return document['one']
+
+
+def test_parallel_postings():
+    importer = PartitionedImporter(partner_id='xx')
+    serial = list(importer.postings('2015Q1'))
+    assert len(serial) == 20
+    tracker = MagicMock()
+    assert list(importer.postings('2015Q1', stats_counter=tracker, processes=2)) == serial
+    assert tracker.track.call_count == 20
+    tracker.track.assert_any_call(
+        input_document={'one': '2015Q1_3_4'},
+        output_document={'id': 'xx_2015Q1_3_4', 'title': '2015Q1_3_4'.upper()}
+    )
+
+
+transformed_count = multiprocessing.Value('i', 0)
+
+
+class LargePartitionImporter(PartitionedImporter):
+    """A partitioned importer that counts, across processes, how many
+    documents it has transformed"""
+    TRANSFORM_BATCH_SIZE = 10
+    PARALLEL_BATCHES_AHEAD = 2
+
+    def _iter_partition_postings(self, partition):
+        for i in range(1000):
+            yield {'one': '{}_{}'.format(partition, i)}
+
+    def _transform(self, document):
+        with transformed_count.get_lock():
+            transformed_count.value += 1
+        if document['one'] == '2015Q1_3_999':
+            raise KeyError('missing field')
+        return super()._transform(document)
+
+
+def test_parallel_postings_bounded():
+    postings = LargePartitionImporter(partner_id='xx').postings('2015Q1', processes=2)
+    assert next(postings)['id'] == 'xx_2015Q1_0_0'
+    time.sleep(0.5)
+    # each worker only transforms a few batches ahead of the consumer
+    assert transformed_count.value < 2 * 6 * 10
+    # errors in a worker are raised in the consumer
+    with pytest.raises(KeyError):
+        list(postings)
+
+
+class BatchTransformImporter(PartitionedImporter):
+    """An importer that transforms documents in batches"""
+    TRANSFORM_BATCH_SIZE = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sizes = []
+
+    def _transform_batch(self, documents):
+        self.batch_sizes.append(len(documents))
+        return [self._transform(document) for document in documents]
+
+
+def test_transform_batch():
+    importer = BatchTransformImporter(partner_id='xx')
+    expected = list(PartitionedImporter(partner_id='xx').postings('2015Q1'))
+    assert list(importer.postings('2015Q1')) == expected
+    assert importer.batch_sizes == [3] * 6 + [2]
+
+    async def collect():
+        return [posting async for posting in importer.apostings('2015Q1')]
+
+    assert asyncio.run(collect()) == expected
+
+
+def test_transform_batch_wrong_length():
+    class DroppingImporter(BatchTransformImporter):
+        def _transform_batch(self, documents):
+            return super()._transform_batch(documents)[1:]
+
+    importer = DroppingImporter(partner_id='xx')
+    with pytest.raises(ValueError, match='_transform_batch returned 2 documents for a batch of 3'):
+        list(importer.postings('2015Q1'))
+
+    async def collect():
+        return [posting async for posting in importer.apostings('2015Q1')]
+
+    with pytest.raises(ValueError, match='_transform_batch'):
+        asyncio.run(collect())
+
+
+class CountingImporter(PartitionedImporter):
+    """A partitioned importer that counts how many documents it transforms"""
+    transformed_count = 0
+
+    def _transform(self, document):
+        self.transformed_count += 1
+        return super()._transform(document)
+
+
+def test_checkpoint_resume(tmpdir):
+    checkpoint_path = str(tmpdir.join('checkpoints', '2015Q1.json'))
+    expected = list(PartitionedImporter(partner_id='xx').postings('2015Q1'))
+
+    first_run = CountingImporter(partner_id='xx')
+    postings = first_run.postings('2015Q1', checkpoint=ImportCheckpoint(checkpoint_path, save_every=2))
+    consumed = [next(postings) for _ in range(8)]
+    # simulate a crash while the eighth posting is being processed,
+    # so it is not yet recorded as consumed
+    postings.close()
+
+    second_run = CountingImporter(partner_id='xx')
+    checkpoint = ImportCheckpoint(checkpoint_path, save_every=2)
+    resumed = list(second_run.postings('2015Q1', checkpoint=checkpoint))
+    assert consumed + resumed[1:] == expected
+    assert second_run.transformed_count == 13
+    assert checkpoint.done
+    assert list(second_run.postings('2015Q1', checkpoint=checkpoint)) == []
+
+    parallel_checkpoint = ImportCheckpoint(str(tmpdir.join('parallel.json')))
+    first_run = PartitionedImporter(partner_id='xx').postings(
+        '2015Q1',
+        processes=2,
+        checkpoint=parallel_checkpoint
+    )
+    consumed = [next(first_run) for _ in range(12)]
+    first_run.close()
+    parallel_checkpoint.save()
+    resumed = PartitionedImporter(partner_id='xx').postings(
+        '2015Q1',
+        processes=2,
+        checkpoint=ImportCheckpoint(str(tmpdir.join('parallel.json')))
+    )
+    assert consumed + list(resumed)[1:] == expected
+
+
+def test_checkpoint_unpartitioned(tmpdir):
+    checkpoint = ImportCheckpoint(str(tmpdir.join('checkpoint.json')), save_every=1)
+    postings = PopulatedImporter(partner_id='xx').postings('2015Q1', checkpoint=checkpoint)
+    assert next(postings) == {'id': 'xx_two', 'title': 'two'}
+    next(postings)
+    postings.close()
+    checkpoint = ImportCheckpoint(str(tmpdir.join('checkpoint.json')))
+    assert list(PopulatedImporter(partner_id='xx').postings('2015Q1', checkpoint=checkpoint)) == [
+        {'id': 'xx_four', 'title': 'four'}
+    ]
+
+
+def test_checkpoint_partition_key_order(tmpdir):
+    checkpoint = ImportCheckpoint(str(tmpdir.join('checkpoint.json')))
+    checkpoint.load('2015Q1')
+    checkpoint.complete_partition({'state': 'MI', 'page': 1})
+    assert checkpoint.is_complete({'page': 1, 'state': 'MI'})
+    assert not checkpoint.is_complete({'page': 2, 'state': 'MI'})
+
+
+def test_dedupe():
+    seen = HashSet()
+    seen.add('xx_two')
+    importer = PopulatedImporter(partner_id='xx')
+    assert list(importer.postings('2015Q1', dedupe=seen)) == [{'id': 'xx_four', 'title': 'four'}]
+    assert list(importer.postings('2015Q1', dedupe=seen)) == []
+
+    counting_importer = CountingImporter(partner_id='xx')
+    for importer, processes in (
+        (counting_importer, None),
+        (BatchTransformImporter(partner_id='xx'), None),
+        (PartitionedImporter(partner_id='xx'), 2),
+    ):
+        seen = HashSet()
+        seen.add('xx_2015Q1_0_1')
+        seen.add('xx_2015Q1_3_3')
+        postings = list(importer.postings('2015Q1', processes=processes, dedupe=seen))
+        assert len(postings) == 18
+        assert 'xx_2015Q1_0_2' in seen
+    assert counting_importer.transformed_count == 18
+
+
+class FailingImporter(PopulatedImporter):
+    def _transform(self, document):
+        if document['one'] == 'four':
+            raise KeyError('missing field')
+        return super()._transform(document)
+
+
+def test_dedupe_marks_consumed_postings_only():
+    for importer in (BatchTransformImporter(partner_id='xx'), PartitionedImporter(partner_id='xx')):
+        for processes in (None, 2):
+            seen = HashSet()
+            postings = importer.postings('2015Q1', processes=processes, dedupe=seen)
+            next(postings)
+            next(postings)
+            postings.close()
+            # the second posting was handed out, but not consumed
+            assert 'xx_2015Q1_0_0' in seen
+            assert 'xx_2015Q1_0_1' not in seen
+            assert len(seen) == 1
+
+    seen = HashSet()
+    with pytest.raises(KeyError):
+        list(FailingImporter(partner_id='xx').postings('2015Q1', dedupe=seen))
+    assert 'xx_two' in seen
+    assert 'xx_four' not in seen
+
+
+def test_import_stats(tmpdir):
+    stats = ImportStats()
+    seen = HashSet()
+    seen.add('xx_2015Q1_0_0')
+    postings = list(PartitionedImporter(partner_id='xx').postings('2015Q1', stats_counter=stats, dedupe=seen))
+    assert len(postings) == 19
+    summary = stats.summary()
+    assert summary['input_documents'] == 20
+    assert summary['output_documents'] == 19
+    assert summary['skipped_documents'] == 1
+    assert summary['field_fill_rates']['title'] == 1.0
+    assert summary['field_fill_rates']['description'] == 0.0
+    assert summary['stage_seconds']['iter_postings'] > 0
+    assert summary['stage_seconds']['transform'] > 0
+
+    parallel_stats = ImportStats()
+    list(PartitionedImporter(partner_id='xx').postings('2015Q1', stats_counter=parallel_stats, processes=2))
+    assert parallel_stats.output_documents == 20
+    assert parallel_stats.stage_seconds['transform'] > 0
+
+    error_stats = ImportStats()
+    with pytest.raises(KeyError):
+        list(FailingImporter(partner_id='xx').postings('2015Q1', stats_counter=error_stats))
+    assert error_stats.errors == 1
+    assert error_stats.input_documents == 2
+
+    class FailingBatchImporter(BatchTransformImporter):
+        def _transform_batch(self, documents):
+            if len(self.batch_sizes) == 1:
+                raise KeyError('missing field')
+            return super()._transform_batch(documents)
+
+    batch_error_stats = ImportStats()
+    with pytest.raises(KeyError):
+        list(FailingBatchImporter(partner_id='xx').postings('2015Q1', stats_counter=batch_error_stats))
+    # one error for each posting in the failed batch
+    assert batch_error_stats.errors == 3
+    assert batch_error_stats.input_documents == 6
+
+    path = str(tmpdir.join('stats.json'))
+    stats.save(path)
+    with open(path) as f:
+        assert json.load(f)['output_documents'] == 19
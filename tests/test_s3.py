@@ -1,9 +1,13 @@
 from moto import mock_s3_deprecated, mock_s3
 import boto
+import gzip
+import pytest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import tempfile
-from skills_utils.s3 import download, upload, upload_dict, list_files, S3BackedJsonDict
+from skills_utils.s3 import download, upload, upload_dict, UploadError, list_files, iter_files, stream_json_lines, S3StreamReader, S3BackedJsonDict
 
 
 @mock_s3_deprecated
@@ -62,8 +66,8 @@ def test_upload_dict():
 
     upload_dict(s3_conn, 'test-bucket/apath', data_to_sync)
 
-    assert key.get_contents_as_string().decode('utf-8')\
-        == '{"stuff": "new contents"}'
+    assert json.loads(key.get_contents_as_string().decode('utf-8'))\
+        == {'stuff': 'new contents'}
 
 
 @mock_s3_deprecated
@@ -135,3 +139,304 @@ def test_S3BackedJSONDict_basic():
         ('key4', 'value4'),
         ('key5', 'value5')
     ]
+
+
+@mock_s3_deprecated
+def test_multipart_upload_and_ranged_download(tmpdir):
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    part_size = 5 * 1024 * 1024
+    data = os.urandom(2 * part_size + 1000)
+    local_path = str(tmpdir.join('model.bin'))
+    with open(local_path, 'wb') as f:
+        f.write(data)
+
+    # moto's mocked S3 mixes up concurrent requests, so transfer one part at a time
+    progress = []
+    upload(
+        s3_conn,
+        local_path,
+        'test-bucket/models',
+        part_size=part_size,
+        concurrency=1,
+        multipart_threshold=part_size,
+        cb=lambda num_bytes, total: progress.append((num_bytes, total))
+    )
+    key = bucket.get_key('models/model.bin')
+    assert key.etag.strip('"').endswith('-3')
+    assert sorted(progress)[-1] == (len(data), len(data))
+
+    out_path = str(tmpdir.join('downloaded.bin'))
+    progress = []
+    download(
+        s3_conn,
+        out_path,
+        'test-bucket/models/model.bin',
+        part_size=part_size,
+        concurrency=1,
+        multipart_threshold=part_size,
+        cb=lambda num_bytes, total: progress.append((num_bytes, total))
+    )
+    with open(out_path, 'rb') as f:
+        assert f.read() == data
+    assert len(progress) == 3
+
+    # downloading with a different part size is checked against the part
+    # size the upload recorded
+    key_class = boto.s3.key.Key
+    get_contents = key_class.get_contents_as_string
+
+    def corrupted_range(self, headers):
+        contents = get_contents(self, headers=headers)
+        if headers['Range'].startswith('bytes=0-'):
+            contents = b'x' + contents[1:]
+        return contents
+
+    with patch.object(key_class, 'get_contents_as_string', corrupted_range):
+        with pytest.raises(ValueError):
+            download(
+                s3_conn,
+                out_path,
+                'test-bucket/models/model.bin',
+                part_size=part_size * 2,
+                concurrency=1,
+                multipart_threshold=part_size
+            )
+
+    # without a recorded part size, the multipart ETag can't be checked
+    with patch.object(key_class, 'get_metadata', return_value=None), \
+            patch.object(key_class, 'get_contents_as_string', corrupted_range):
+        download(
+            s3_conn,
+            out_path,
+            'test-bucket/models/model.bin',
+            part_size=part_size,
+            concurrency=1,
+            multipart_threshold=part_size
+        )
+
+
+@mock_s3_deprecated
+def test_ranged_download_concurrent(tmpdir):
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    part_size = 1024
+    data = os.urandom(10 * part_size + 100)
+    key = boto.s3.key.Key(bucket=bucket, name='models/model.bin')
+    key.set_contents_from_string(data)
+    out_path = str(tmpdir.join('model.bin'))
+
+    # moto's mocked S3 mixes up concurrent requests, so serve the ranges locally
+    def get_range(self, headers):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        return data[int(start):int(end) + 1]
+
+    def download_concurrently():
+        download(
+            s3_conn,
+            out_path,
+            'test-bucket/models/model.bin',
+            part_size=part_size,
+            concurrency=4,
+            multipart_threshold=part_size
+        )
+
+    with patch('boto.s3.key.Key.get_contents_as_string', get_range):
+        download_concurrently()
+        with open(out_path, 'rb') as f:
+            assert f.read() == data
+
+        # encrypted with KMS, the ETag is not an MD5 and is not checked
+        key.etag = '"{}"'.format('0' * 32)
+        with patch('boto.s3.bucket.Bucket.get_key', return_value=key):
+            with pytest.raises(ValueError):
+                download_concurrently()
+            key.encrypted = 'aws:kms'
+            download_concurrently()
+
+
+@mock_s3_deprecated
+def test_download_checksum_mismatch(tmpdir):
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    key = boto.s3.key.Key(bucket=bucket, name='apath/akey')
+    key.set_contents_from_string('test')
+    out_path = str(tmpdir.join('akey'))
+
+    def corrupted_download(self, filename, cb):
+        with open(filename, 'w') as f:
+            f.write('tost')
+
+    with patch('boto.s3.key.Key.get_contents_to_filename', corrupted_download):
+        with pytest.raises(ValueError):
+            download(s3_conn, out_path, 'test-bucket/apath/akey')
+
+
+@mock_s3_deprecated
+def test_upload_dict_skip_unchanged_and_retry():
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    data_to_sync = {
+        'keyone': {'stuff': 'contents'},
+        'keytwo': {'stuff2': 'contents2'},
+    }
+    assert upload_dict(s3_conn, 'test-bucket/apath', data_to_sync) == {
+        'keyone': 'uploaded',
+        'keytwo': 'uploaded',
+    }
+
+    data_to_sync['keytwo'] = {'stuff2': 'new contents2'}
+    data_to_sync['keythree'] = {'stuff3': 'contents3'}
+    set_contents = boto.s3.key.Key.set_contents_from_string
+    failures = []
+
+    def flaky_set_contents(self, contents):
+        if self.name.endswith('keythree.json') and not failures:
+            failures.append(self.name)
+            raise boto.exception.S3ResponseError(503, 'Slow Down')
+        if self.name.endswith('keyfour.json'):
+            raise boto.exception.S3ResponseError(403, 'Forbidden')
+        return set_contents(self, contents)
+
+    data_to_sync['keyfour'] = {}
+    with patch('boto.s3.key.Key.set_contents_from_string', flaky_set_contents), \
+            patch('skills_utils.s3.RETRY_BACKOFF', 0):
+        results = upload_dict(
+            s3_conn,
+            'test-bucket/apath',
+            data_to_sync,
+            skip_unchanged=True,
+            retries=2,
+            raise_on_error=False
+        )
+    assert results == {
+        'keyone': 'unchanged',
+        'keytwo': 'uploaded',
+        'keythree': 'uploaded',
+        'keyfour': 'failed',
+    }
+    assert failures == ['apath/keythree.json']
+    key = bucket.get_key('apath/keytwo.json')
+    assert json.loads(key.get_contents_as_string().decode('utf-8')) == {'stuff2': 'new contents2'}
+
+
+@mock_s3_deprecated
+def test_upload_dict_raises_on_failure():
+    s3_conn = boto.connect_s3()
+    s3_conn.create_bucket('test-bucket')
+
+    def forbidden(self, contents):
+        if self.name.endswith('keytwo.json'):
+            raise boto.exception.S3ResponseError(403, 'Forbidden')
+
+    data_to_sync = {'keyone': {}, 'keytwo': {}}
+    with patch('boto.s3.key.Key.set_contents_from_string', forbidden):
+        with pytest.raises(UploadError) as excinfo:
+            upload_dict(s3_conn, 'test-bucket/apath', data_to_sync)
+    assert list(excinfo.value.errors) == ['keytwo']
+    assert excinfo.value.results == {'keyone': 'uploaded', 'keytwo': 'failed'}
+
+
+@mock_s3_deprecated
+def test_upload_dict_concurrent():
+    s3_conn = boto.connect_s3()
+    s3_conn.create_bucket('test-bucket')
+    uploaded = {}
+
+    # moto's mocked S3 mixes up concurrent requests, so only record the uploads
+    def record_contents(self, contents):
+        uploaded[self.name] = contents
+
+    # uploads are submitted a window (twice the concurrency) at a time,
+    # rather than all up front
+    class Values(object):
+        def items(self):
+            for i in range(50):
+                assert len(uploaded) >= i - 16
+                yield 'key{}'.format(i), {'value': i}
+
+    with patch('boto.s3.key.Key.set_contents_from_string', record_contents):
+        results = upload_dict(s3_conn, 'test-bucket/apath', Values(), concurrency=8)
+    assert set(results.values()) == {'uploaded'}
+    assert len(uploaded) == 50
+    assert json.loads(uploaded['apath/key7.json']) == {'value': 7}
+
+
+@mock_s3_deprecated
+def test_iter_files():
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    names = ['raw/top.json'] + [
+        'raw/{}/{}/postings_{}.json'.format(quarter, partner, i)
+        for quarter in ('2015Q1', '2015Q2', '2015Q3')
+        for partner in ('XX', 'YY')
+        for i in range(3)
+    ]
+    for name in names:
+        boto.s3.key.Key(bucket=bucket, name=name).set_contents_from_string(name)
+
+    files = list(iter_files(s3_conn, 'test-bucket/raw/'))
+    assert [s3_file.name for s3_file in files] == sorted(names)
+    assert files[0].size == len(files[0].name)
+    assert files[0].etag == bucket.get_key(files[0].name).etag.strip('"')
+    assert files[0].last_modified
+
+    # moto's mocked S3 mixes up concurrent requests, so list one sub-prefix at a time
+    with patch('skills_utils.s3.ThreadPoolExecutor', lambda workers: ThreadPoolExecutor(1)):
+        parallel = list(iter_files(s3_conn, 'test-bucket/raw/', concurrency=4))
+    assert sorted(parallel) == files
+
+    # closing the listing early cancels the sub-prefixes not yet listed
+    listed = []
+    bucket_list = boto.s3.bucket.Bucket.list
+
+    def recorded_list(self, prefix='', **kwargs):
+        listed.append(prefix)
+        return bucket_list(self, prefix=prefix, **kwargs)
+
+    listing = iter_files(s3_conn, 'test-bucket/raw/', concurrency=4)
+    with patch('skills_utils.s3.ThreadPoolExecutor', lambda workers: ThreadPoolExecutor(1)), \
+            patch('boto.s3.bucket.Bucket.list', recorded_list):
+        assert next(listing).name == 'raw/top.json'
+        next(listing)
+        listing.close()
+    assert 'raw/2015Q3/' not in listed
+
+
+@mock_s3_deprecated
+def test_stream_json_lines():
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    lines = b'\n'.join(json.dumps({'id': i}).encode('utf-8') for i in range(200)) + b'\n'
+    for name, contents in (('postings.json', lines), ('postings.json.gz', gzip.compress(lines))):
+        boto.s3.key.Key(bucket=bucket, name=name).set_contents_from_string(contents)
+        postings = stream_json_lines(
+            s3_conn,
+            'test-bucket/' + name,
+            block_size=100,
+            read_ahead=2
+        )
+        assert [posting['id'] for posting in postings] == list(range(200))
+
+    parallel = stream_json_lines(s3_conn, 'test-bucket/postings.json.gz', block_size=1000, processes=2)
+    assert sorted(posting['id'] for posting in parallel) == list(range(200))
+
+    postings = stream_json_lines(s3_conn, 'test-bucket/postings.json', block_size=100, read_ahead=1)
+    assert next(postings) == {'id': 0}
+    postings.close()
+
+    with pytest.raises(boto.exception.S3ResponseError):
+        next(stream_json_lines(s3_conn, 'test-bucket/missing.json'))
+
+
+@mock_s3_deprecated
+def test_S3StreamReader_reads():
+    s3_conn = boto.connect_s3()
+    bucket = s3_conn.create_bucket('test-bucket')
+    data = os.urandom(1000)
+    boto.s3.key.Key(bucket=bucket, name='data.bin').set_contents_from_string(data)
+    with S3StreamReader(bucket.get_key('data.bin'), block_size=64) as reader:
+        assert reader.read(10) == data[:10]
+        assert reader.read(100) == data[10:110]
+        assert reader.read() == data[110:]
+        assert reader.read(10) == b''
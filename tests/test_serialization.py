@@ -0,0 +1,39 @@
+from skills_utils import serialization
+from skills_utils.serialization import available_backends, get_backend
+import json
+import pytest
+
+
+def test_backends_round_trip():
+    document = {'title': 'Nurse', 'skills': ['care', 'café'], 'salary': 3.5, 'remote': None}
+    assert 'json' in available_backends()
+    for name in available_backends():
+        backend = get_backend(name)
+        assert backend.loads(backend.dumps(document)) == document
+        assert backend.loads(backend.dumps_bytes(document)) == document
+
+
+def test_backend_falls_back_on_unsupported_values():
+    document = {'id': 2 ** 70 + 1, 'negative': -2 ** 63 - 1, 'title': 'Nurse'}
+    for name in available_backends():
+        backend = get_backend(name)
+        for loaded in (
+            backend.loads(backend.dumps(document)),
+            backend.loads(backend.dumps_bytes(document)),
+            backend.loads(json.dumps(document)),
+        ):
+            assert loaded == document
+            assert isinstance(loaded['id'], int)
+        # what json writes, any backend reads
+        assert backend.loads('[NaN, Infinity]')[1] == float('inf')
+
+
+def test_set_backend():
+    original = serialization.backend.name
+    try:
+        assert serialization.set_backend('json').name == 'json'
+        assert serialization.dumps({'a': 1}) == '{"a": 1}'
+    finally:
+        serialization.set_backend(original)
+    with pytest.raises(ValueError):
+        get_backend('notajsonlibrary')